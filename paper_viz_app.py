@@ -1,17 +1,146 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.font_manager as fm
-import seaborn as sns
 import io
 import json
-import random
 import sys
 import os
-import requests
-from matplotlib.patches import Polygon as MplPolygon
-from matplotlib.collections import PatchCollection
+import re
+import time
+import hashlib
+import threading
+import uuid
+import logging
+import shutil
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+# Matplotlib / seaborn / requests 较重，在首次绘图或联网时才在函数内导入，缩短冷启动时间
+
+# --- 性能埋点 (分阶段耗时与峰值内存) ---
+# 设置 ACADEMICVIZ_PERF_LOG=<文件路径> (或 "-" 表示标准错误) 后，每个阶段结束时写一行 JSON 日志
+PERF_LOG_PATH = os.environ.get("ACADEMICVIZ_PERF_LOG")
+perf_logger = logging.getLogger("academicviz.perf")
+if PERF_LOG_PATH and not perf_logger.handlers:  # 脚本每次重跑都会执行模块代码，避免重复添加
+    _perf_handler = logging.StreamHandler() if PERF_LOG_PATH == "-" else logging.FileHandler(PERF_LOG_PATH,
+                                                                                            encoding="utf-8")
+    _perf_handler.setFormatter(logging.Formatter("%(message)s"))
+    perf_logger.addHandler(_perf_handler)
+    perf_logger.setLevel(logging.INFO)
+    perf_logger.propagate = False
+_PERF = threading.local()
+# tracemalloc 是进程级的：统计内存的记录器按引用计数共同启停；epoch 在每个记录器进入时递增，
+# 阶段开始与结束时 epoch 相同且只有一个记录器在统计，才说明期间没有其他记录器重置过峰值
+_TRACE_LOCK = threading.Lock()
+_TRACE = {"users": 0, "owned": False, "epoch": 0}
+
+
+def _trace_epoch():
+    """当前线程的记录器是唯一在统计内存的记录器时返回当前 epoch，否则返回 None (不统计内存)。"""
+    recorder = getattr(_PERF, "recorder", None)
+    if recorder is None or not recorder.trace_memory:
+        return None
+    with _TRACE_LOCK:
+        return _TRACE["epoch"] if _TRACE["users"] == 1 and tracemalloc.is_tracing() else None
+
+
+class PerfRecorder:
+    """
+    收集一次运行 (一次页面重跑 / 一个基准用例) 中各阶段的记录，作用域为当前线程。
+    trace_memory=True 时用 tracemalloc 统计各阶段的峰值内存增量 (有一定开销，只在调试面板与基准中开启)；
+    多个会话同时开启时 tracemalloc 由它们共同启停，但只在仅有一个记录器统计内存时才记录 peak_mb，
+    否则各会话会相互重置峰值。其他未统计内存的线程的分配仍会计入，数字仅作参考。
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.records = []
+
+    def __enter__(self):
+        self._previous = getattr(_PERF, "recorder", None)
+        _PERF.recorder = self
+        if self.trace_memory:
+            with _TRACE_LOCK:
+                if _TRACE["users"] == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _TRACE["owned"] = True
+                _TRACE["users"] += 1
+                _TRACE["epoch"] += 1
+        return self
+
+    def __exit__(self, *exc):
+        _PERF.recorder = self._previous
+        if self.trace_memory:
+            with _TRACE_LOCK:
+                _TRACE["users"] -= 1
+                if _TRACE["users"] == 0 and _TRACE["owned"]:
+                    # 只停止由记录器启动的追踪 (python -X tracemalloc 等外部开启的保持不动)
+                    tracemalloc.stop()
+                    _TRACE["owned"] = False
+        return False
+
+    def summary(self):
+        """按阶段汇总：次数、总耗时、最大单次耗时与最大峰值内存。"""
+        if not self.records:
+            return pd.DataFrame(columns=["stage", "calls", "total_ms", "max_ms", "peak_mb"])
+        records = pd.DataFrame(self.records)
+        if "peak_mb" not in records:
+            records["peak_mb"] = np.nan
+        return (records.groupby("stage", sort=False)
+                .agg(calls=("ms", "size"), total_ms=("ms", "sum"), max_ms=("ms", "max"), peak_mb=("peak_mb", "max"))
+                .reset_index())
+
+
+@contextmanager
+def perf_stage(name, **fields):
+    """
+    记录一个阶段的耗时 (及峰值内存)：写入当前线程的 PerfRecorder，并按需输出 JSON 日志。
+    既没有记录器也没有开启日志时什么都不做。阶段可以嵌套，外层的峰值包含内层。
+    """
+    recorder = getattr(_PERF, "recorder", None)
+    if recorder is None and not perf_logger.isEnabledFor(logging.INFO):
+        yield
+        return
+    stack = _PERF.__dict__.setdefault("stack", [])
+    frame = {}
+    epoch = _trace_epoch()
+    if epoch is not None:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack and "peak" in stack[-1]:
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        tracemalloc.reset_peak()
+        frame = {"start": current, "peak": current, "epoch": epoch}
+    stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        record = {"stage": name, "ms": round(elapsed * 1000, 2), "depth": len(stack), **fields}
+        if frame and _trace_epoch() == frame["epoch"]:
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            record["peak_mb"] = round((peak - frame["start"]) / 2 ** 20, 2)
+            if stack and "peak" in stack[-1]:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        if recorder is not None:
+            recorder.records.append(record)
+        perf_logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def perf_timed(name):
+    """装饰器形式的 perf_stage。放在缓存装饰器之内，只记录真正执行的计算 (缓存命中不记录)。"""
+    def decorate(func):
+        import functools
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with perf_stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
 
 # --- 常用城市 Adcode 映射 (部分示例，可扩展) ---
 CITY_ADCODE_MAP = {
@@ -53,10 +182,180 @@ CITY_ADCODE_MAP = {
 }
 
 
+# --- 全国行政区划代码索引 (随程序分发的数据文件，首次查询时才加载) ---
+ADCODE_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "adcode_index.tsv.gz")
+ADMIN_SUFFIXES = ('特别行政区', '维吾尔自治区', '壮族自治区', '回族自治区', '自治区', '自治州', '自治县', '自治旗',
+                  '地区', '林区', '省', '市', '区', '县', '盟', '旗')
+
+
+def strip_admin_suffix(name):
+    """去掉行政级别后缀 (省/市/区/县/自治州...)，至少保留两个字。"""
+    for suffix in ADMIN_SUFFIXES:
+        if name.endswith(suffix) and len(name) - len(suffix) >= 2:
+            return name[:-len(suffix)]
+    return name
+
+
+class AdcodeIndex:
+    """
+    全国省 / 市 / 区县三级行政区划索引。
+    - 精确匹配全称、简称 (不带 省/市/区/县 等后缀) 与拼音，均为字典查找；
+    - 前缀匹配在排好序的键上二分查找；
+    - 带上级的写法 (如 "深圳南山区"、"黑龙江鹤岗南山区") 用于区分同名区县；
+    - 以上均无结果时可用 suggest 做模糊匹配 (difflib)，结果只作为 "您是否要找" 的提示，不直接采用。
+    """
+
+    def __init__(self, rows):
+        self.codes = [row[0] for row in rows]
+        self.names = {code: name for code, name, _, _ in rows}
+        self._keys = {}
+        for code, name, short, pinyin in rows:
+            for key in {name, short, pinyin}:
+                self._keys.setdefault(key, []).append(code)
+        self._sorted_keys = sorted(self._keys)
+        self._keys_by_char = {}
+        for key in self._sorted_keys:
+            if not key.isascii():
+                for char in set(key):
+                    self._keys_by_char.setdefault(char, []).append(key)
+        self._children = None
+
+    @classmethod
+    def load(cls, path=ADCODE_INDEX_PATH):
+        import gzip
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            rows = [line.rstrip("\n").split("\t") for line in f if not line.startswith("#")]
+        return cls(rows)
+
+    @staticmethod
+    def level(code):
+        """0 = 省级，1 = 地级，2 = 县级。"""
+        return 0 if code.endswith("0000") else (1 if code.endswith("00") else 2)
+
+    def _rank(self, codes):
+        return sorted(dict.fromkeys(codes), key=lambda c: (self.level(c), c))
+
+    def parent(self, code):
+        level = self.level(code)
+        if level == 0:
+            return None
+        city = code[:4] + "00"
+        return city if level == 2 and city in self.names else code[:2] + "0000"
+
+    def children(self, code):
+        if self._children is None:
+            self._children = {}
+            for c in self.codes:
+                p = self.parent(c)
+                if p is not None:
+                    self._children.setdefault(p, []).append(c)
+        return self._children.get(code, [])
+
+    def is_within(self, code, ancestor):
+        level = self.level(ancestor)
+        return code != ancestor and code.startswith(ancestor[:2 + 2 * level])
+
+    def full_name(self, code):
+        """带上级的全称，如 广东省深圳市南山区。"""
+        parts = []
+        while code is not None:
+            parts.append(self.names.get(code, ""))
+            code = self.parent(code)
+        return "".join(reversed(parts))
+
+    def _exact(self, query):
+        return self._keys.get(query) or self._keys.get(strip_admin_suffix(query)) or []
+
+    def _qualified(self, query):
+        # 从最长的上级名称开始尝试：上级 + 剩余部分，剩余部分只在上级的下属中匹配
+        for k in range(len(query) - 2, 1, -1):
+            parents = [c for c in self._exact(query[:k]) if self.level(c) < 2]
+            if not parents:
+                continue
+            rest = query[k:]
+            found = [c for c in (self._exact(rest) or self._qualified(rest))
+                     if any(self.is_within(c, p) for p in parents)]
+            if found:
+                return found
+        return []
+
+    def _prefix(self, query, limit):
+        import bisect
+        found = []
+        i = bisect.bisect_left(self._sorted_keys, query)
+        while i < len(self._sorted_keys) and self._sorted_keys[i].startswith(query) and len(found) < limit * 4:
+            found.extend(self._keys[self._sorted_keys[i]])
+            i += 1
+        return found
+
+    @staticmethod
+    def _normalize(query):
+        query = query.strip()
+        if query.isascii():
+            query = re.sub(r"[\s'’-]", "", query).lower()
+        return query
+
+    def lookup(self, query, limit=10):
+        """
+        返回按相关度排序的 adcode 列表 (同一层匹配内省级优先，再按代码排序)。
+        依次尝试：精确 (全称 / 简称 / 拼音) -> 带上级限定 -> 前缀，取第一个有结果的层。
+        """
+        query = self._normalize(query)
+        if not query:
+            return []
+        found = self._exact(query) or self._qualified(query) or self._prefix(query, limit)
+        return self._rank(found)[:limit]
+
+    def suggest(self, query, limit=3, min_ratio=0.5):
+        """
+        模糊匹配 (difflib)，按相似度排序，用于 lookup 无结果时提示 "您是否要找"。
+        只在与查询至少有一个相同汉字的键中进行；去掉后缀后不超过两个字的查询还要求首字相同，
+        否则 "横州" 之类的短查询几乎能匹配任何带 "州" 字的地区。
+        """
+        query = self._normalize(query)
+        if not query or query.isascii():
+            return []
+        import difflib
+        stem = strip_admin_suffix(query)
+        short = len(stem) <= 2
+        candidates = {key for char in set(stem) for key in self._keys_by_char.get(char, ())}
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(query)
+        scored = {}
+        for key in candidates:
+            if short and not key.startswith(stem[0]):
+                continue
+            matcher.set_seq1(key)
+            if matcher.real_quick_ratio() < min_ratio or matcher.quick_ratio() < min_ratio:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= min_ratio:
+                for c in self._keys[key]:
+                    scored[c] = max(scored.get(c, 0), ratio)
+        # 相同相似度时省级优先
+        return sorted(scored, key=lambda c: (-scored[c], self.level(c), c))[:limit]
+
+
+@st.cache_resource
+def get_adcode_index():
+    """进程级共享的行政区划索引；只在第一次按名称查询时读取数据文件。"""
+    return AdcodeIndex.load()
+
+
+# DataV 边界接口地址，可通过环境变量指向镜像或本地测试服务器
+DATAV_BOUND_URL = os.environ.get("ACADEMICVIZ_DATAV_URL", "https://geo.datav.aliyun.com/areas_v3/bound").rstrip("/")
+
+
+def adcode_url(adcode):
+    """DataV 边界地址：有下级的地区取 {adcode}_full.json (含下级边界)，区县只有 {adcode}.json。"""
+    suffix = "" if AdcodeIndex.level(adcode) == 2 else "_full"
+    return f"{DATAV_BOUND_URL}/{adcode}{suffix}.json"
+
+
 def resolve_map_url(input_str):
     """
     智能解析用户输入，返回 GeoJSON URL。
-    支持：中文名称、Adcode、完整 URL
+    支持：中文名称 (含简称、拼音、带上级的写法)、Adcode、完整 URL
     """
     input_str = input_str.strip()
 
@@ -66,58 +365,2418 @@ def resolve_map_url(input_str):
 
     # 2. 是纯数字 (Adcode)
     if input_str.isdigit() and len(input_str) == 6:
-        return f"https://geo.datav.aliyun.com/areas_v3/bound/{input_str}_full.json", input_str
+        return adcode_url(input_str), input_str
 
     # 3. 是中文名称，查字典
     if input_str in CITY_ADCODE_MAP:
         adcode = CITY_ADCODE_MAP[input_str]
-        return f"https://geo.datav.aliyun.com/areas_v3/bound/{adcode}_full.json", f"{input_str}({adcode})"
+        return adcode_url(adcode), f"{input_str}({adcode})"
+
+    # 4. 查全国行政区划索引 (全称 / 简称 / 拼音 / 前缀 / 带上级)；模糊匹配不自动采用，见 resolve_regions
+    index = get_adcode_index()
+    matches = index.lookup(input_str)
+    if matches:
+        adcode = matches[0]
+        label = f"{index.full_name(adcode)}({adcode})"
+        if len(matches) > 1:
+            label += f" [另有 {len(matches) - 1} 个匹配，可加上级名称区分]"
+        return adcode_url(adcode), label
 
     return None, None
 
 
-# --- 字体处理核心逻辑 ---
-@st.cache_resource
-def get_chinese_font():
+# 多地区输入：以逗号 / 分号 / 顿号 / 空白分隔；以 "/*" 结尾表示该地区的全部下级 (逐个下钻)
+REGION_SEPARATORS = re.compile(r"[,，;；、\s]+")
+REGION_CHILDREN_SUFFIX = "/*"
+
+
+def resolve_regions(input_str):
     """
-    为了解决中文乱码，自动下载并加载 SimHei 字体。
-    使用 cache_resource 避免重复下载。
+    解析多地区输入，如 "南宁, 柳州"、"450100 450200"、"广西/*"。
+    返回 (targets, unresolved)：targets 为 [(url, 显示名称, 是否下钻), ...]，unresolved 为无法识别的输入
+    (有相近的地区名时附带 "您是否要找" 提示)。
     """
-    font_path = "SimHei.ttf"
-    # 尝试使用系统字体
-    system_fonts = [f.name for f in fm.fontManager.ttflist]
-    common_cn_fonts = ['SimHei', 'Microsoft YaHei', 'PingFang SC', 'Heiti TC', 'WenQuanYi Micro Hei']
+    targets, unresolved = [], []
+    tokens = [input_str.strip()] if input_str.strip().startswith("http") else REGION_SEPARATORS.split(input_str)
+    for token in tokens:
+        token = token.strip()
+        if not token:
+            continue
+        drill = token.endswith(REGION_CHILDREN_SUFFIX)
+        if drill:
+            token = token[:-len(REGION_CHILDREN_SUFFIX)]
+        url, name = resolve_map_url(token)
+        if url:
+            targets.append((url, f"{name} 全部下级" if drill else name, drill))
+        else:
+            index = get_adcode_index()
+            suggestions = "、".join(f"{index.full_name(c)}({c})" for c in index.suggest(token))
+            unresolved.append(f"{token} (您是否要找: {suggestions})" if suggestions else token)
+    return targets, unresolved
+
+
+# --- 边界数据缓存 (GeoJSON Boundary Cache) ---
+GEOJSON_CACHE_DIR = os.environ.get("ACADEMICVIZ_CACHE_DIR",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "academicviz", "geojson"))
+GEOJSON_SEED_DIR = os.environ.get("ACADEMICVIZ_GEOJSON_DIR")
+GEOJSON_CACHE_MAX_BYTES = 512 * 1024 * 1024
+GEOJSON_REQUEST_TIMEOUT = 15
+GEOJSON_FETCH_WORKERS = 8  # 并发抓取的线程数，同时也是连接池大小
+GEOJSON_FETCH_RETRIES = 3
+GEOJSON_RETRY_BACKOFF = 0.5  # 重试间隔 0.5 s, 1 s, 2 s ...
 
-    for font in common_cn_fonts:
-        if font in system_fonts:
-            return fm.FontProperties(family=font)
 
-    # 如果系统没有，则检查本地是否有文件，没有则下载
-    if not os.path.exists(font_path):
-        url = "https://github.com/StellarCN/scp_zh/raw/master/fonts/SimHei.ttf"  # 使用一个稳定的字体源
+class BoundaryCache:
+    """
+    GeoJSON 边界数据的两级缓存 (内存 + 磁盘)。
+    - 以 Adcode (无法识别时以 URL 哈希) 为键；
+    - 磁盘部分有容量上限，按最近访问时间 (LRU) 淘汰；
+    - 通过 ETag / If-Modified-Since 条件请求重新验证；
+    - 可从本地目录预置数据 ({adcode}.json 或 {adcode}_full.json)，离线模式下完全不访问网络；
+    - 所有请求共用一个带连接池和退避重试的 Session，按键加锁，不同地区可并发抓取；
+    - keep_in_memory=False 时不常驻解析后的数据 (页面中由 GeometryStore 保存紧凑形式)。
+    """
+
+    def __init__(self, cache_dir=GEOJSON_CACHE_DIR, max_bytes=GEOJSON_CACHE_MAX_BYTES, seed_dir=GEOJSON_SEED_DIR,
+                 offline=False, timeout=GEOJSON_REQUEST_TIMEOUT, revalidate_after=24 * 3600, keep_in_memory=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.seed_dir = seed_dir
+        self.offline = offline
+        self.timeout = timeout
+        self.revalidate_after = revalidate_after
+        self.keep_in_memory = keep_in_memory
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "stale": 0, "seeded": 0}
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.session = requests.Session()
+        retry = Retry(total=GEOJSON_FETCH_RETRIES, backoff_factor=GEOJSON_RETRY_BACKOFF,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=GEOJSON_FETCH_WORKERS, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _remember(self, key, data, meta):
+        if self.keep_in_memory:
+            self._memory[key] = (data, meta)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def cache_key(url):
+        """DataV 边界地址 ({DATAV_BOUND_URL}/{adcode}[_full].json) 以 Adcode 为键，其他地址一律以 URL 哈希为键。"""
+        prefix = DATAV_BOUND_URL + "/"
+        match = re.fullmatch(r"(\d{6})(_full)?\.json", url[len(prefix):]) if url.startswith(prefix) else None
+        if match:
+            return match.group(1) + (match.group(2) or "")
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + ".json", base + ".meta.json"
+
+    def _read_disk(self, key):
+        data_path, meta_path = self._paths(key)
+        if not os.path.exists(data_path):
+            return None, None
         try:
-            with st.spinner("正在下载中文字体以修复乱码 (仅首次运行)..."):
-                resp = requests.get(url)
-                with open(font_path, "wb") as f:
-                    f.write(resp.content)
+            with open(data_path, "rb") as f:
+                data = json.loads(f.read())
+            meta = {}
+            if os.path.exists(meta_path):
+                with open(meta_path, "r", encoding="utf-8") as f:
+                    meta = json.load(f)
+            os.utime(data_path)  # 刷新访问时间，用于 LRU
+            return data, meta
+        except (OSError, ValueError):
+            return None, None
+
+    def _write_disk(self, key, content, meta):
+        data_path, meta_path = self._paths(key)
+        tmp_path = data_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, data_path)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        with self._lock:
+            self._evict()
+
+    def _touch_meta(self, key, meta):
+        _, meta_path = self._paths(key)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(".json") or fname.endswith(".meta.json"):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            st_ = os.stat(path)
+            entries.append((st_.st_mtime, st_.st_size, fname[:-len(".json")]))
+            total += st_.st_size
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _, size, key = entries.pop(0)
+            for path in self._paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._memory.pop(key, None)
+            total -= size
+
+    def _read_seed(self, key):
+        if not self.seed_dir:
+            return None
+        adcode = key.split("_")[0]
+        for fname in (f"{key}.json", f"{adcode}_full.json", f"{adcode}.json"):
+            path = os.path.join(self.seed_dir, fname)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    return f.read()
+        return None
+
+    def get(self, url):
+        """
+        返回 (geojson_dict, 来源)，来源为 memory / disk / seed / network / revalidated / stale。
+        网络请求失败时抛出异常，调用方负责提示用户。
+        """
+        import requests
+        key = self.cache_key(url)
+        with self._key_lock(key):
+            entry = self._memory.get(key)
+            if entry is not None and (self.offline or time.time() - entry[1].get("checked_at", 0) < self.revalidate_after):
+                self._count("hits")
+                return entry[0], "memory"
+
+            data, meta = (entry if entry is not None else self._read_disk(key))
+            if data is None:
+                content = self._read_seed(key)
+                if content is not None:
+                    data = json.loads(content)
+                    meta = {"url": url, "checked_at": time.time(), "seeded": True}
+                    self._write_disk(key, content, meta)
+                    self._remember(key, data, meta)
+                    self._count("seeded")
+                    return data, "seed"
+
+            if data is not None and (self.offline or meta.get("seeded")
+                                     or time.time() - meta.get("checked_at", 0) < self.revalidate_after):
+                self._remember(key, data, meta)
+                self._count("hits")
+                return data, "disk"
+
+            if data is None and self.offline:
+                self._count("misses")
+                raise FileNotFoundError(f"离线模式下缓存中没有 {key} 的边界数据，请先预置到 {self.seed_dir or self.cache_dir}")
+
+            headers = {}
+            if data is not None:
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+
+            try:
+                resp = self.session.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException:
+                if data is not None:
+                    # 网络不可用时退回到旧数据
+                    self._remember(key, data, meta)
+                    self._count("stale")
+                    return data, "stale"
+                raise
+
+            if resp.status_code == 304 and data is not None:
+                meta["checked_at"] = time.time()
+                self._touch_meta(key, meta)
+                self._remember(key, data, meta)
+                self._count("revalidated")
+                return data, "revalidated"
+
+            resp.raise_for_status()
+            data = resp.json()
+            meta = {"url": url, "checked_at": time.time(),
+                    "etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")}
+            self._write_disk(key, resp.content, meta)
+            self._remember(key, data, meta)
+            self._count("misses")
+            return data, "network"
+
+
+@st.cache_resource
+def get_boundary_cache(offline=False):
+    """进程级共享的边界缓存实例。解析结果由 GeometryStore 以紧凑数组常驻，这里只保留磁盘层。"""
+    return BoundaryCache(offline=offline, keep_in_memory=False)
+
+
+def _fetch_all(cache, requests_, workers):
+    """并发抓取 [(url, 名称), ...]，返回与输入同序的 (数据, 来源, 错误) 列表；单个失败不影响其它地区。"""
+    import requests
+
+    def fetch(item):
+        url, _ = item
+        try:
+            data, source = cache.get(url)
+            return data, source, None
         except Exception as e:
-            st.warning(f"字体下载失败: {e}，图表中文可能无法显示。")
+            if isinstance(e, requests.HTTPError) and e.response is not None:
+                return None, None, f"HTTP {e.response.status_code}"
+            if isinstance(e, requests.exceptions.RetryError):
+                return None, None, f"重试 {GEOJSON_FETCH_RETRIES} 次后仍失败"
+            return None, None, f"{type(e).__name__}: {e}"
+
+    if len(requests_) <= 1:
+        return [fetch(item) for item in requests_]
+    with ThreadPoolExecutor(max_workers=min(workers, len(requests_))) as pool:
+        return list(pool.map(fetch, requests_))
+
+
+@perf_timed("geometry.fetch")
+def fetch_regions(targets, cache, workers=GEOJSON_FETCH_WORKERS):
+    """
+    抓取 resolve_regions 得到的多个地区并合并为一个 FeatureCollection。
+    下钻目标先取本级边界，再并发抓取每个下级的 {adcode}_full.json；
+    某个下级抓取失败或本身没有下级时，保留本级边界中的该要素。
+    返回 (geojson, report)，report 为逐个地区的 {region, url, source, error}。
+    """
+    report = []
+    features = []
+    first = _fetch_all(cache, [(url, name) for url, name, _ in targets], workers)
+    drill_children = []
+    for (url, name, drill), (data, source, error) in zip(targets, first):
+        report.append({"region": name, "url": url, "source": source, "error": error})
+        if data is None:
+            continue
+        for feature in data.get("features", []):
+            props = feature.get("properties") or {}
+            adcode = str(props.get("adcode", ""))
+            if drill and props.get("childrenNum", 1) and re.fullmatch(r"\d{6}", adcode) and adcode != url.rsplit("/", 1)[-1][:6]:
+                drill_children.append((adcode_url(adcode), props.get("name", adcode), feature))
+            else:
+                features.append(feature)
+
+    second = _fetch_all(cache, [(url, name) for url, name, _ in drill_children], workers)
+    for (url, name, parent_feature), (data, source, error) in zip(drill_children, second):
+        report.append({"region": name, "url": url, "source": source, "error": error})
+        if data is None:
+            features.append(parent_feature)
+        else:
+            features.extend(data.get("features", []))
+
+    seen = set()
+    merged = []
+    for feature in features:
+        props = feature.get("properties") or {}
+        ident = (props.get("adcode"), props.get("name")) if props.get("adcode") else id(feature)
+        if ident not in seen:
+            seen.add(ident)
+            merged.append(feature)
+    return {"type": "FeatureCollection", "features": merged}, report
+
+
+def regions_cache_key(targets):
+    """多地区合并结果的缓存键；单个地区沿用 BoundaryCache.cache_key。"""
+    if len(targets) == 1 and not targets[0][2]:
+        return BoundaryCache.cache_key(targets[0][0])
+    return "multi-" + hashlib.sha1(repr(sorted((url, drill) for url, _, drill in targets)).encode("utf-8")).hexdigest()
+
+
+# --- 进程级几何存储 (紧凑数组形式，跨会话共享) ---
+GEOMETRY_STORE_DIR = os.environ.get("ACADEMICVIZ_GEOMETRY_DIR",
+                                    os.path.join(os.path.expanduser("~"), ".cache", "academicviz", "geometry"))
+GEOMETRY_STORE_MAX_BYTES = 1024 * 1024 * 1024  # 内存中常驻几何的上限
+GEOMETRY_DISK_MAX_BYTES = 2 * 1024 * 1024 * 1024
+GEOMETRY_MAX_AGE = 24 * 3600  # 超过此时长的几何在下次请求时重新走边界缓存校验
+GEOMETRY_TYPES = (None, 'Polygon', 'MultiPolygon')
+
+
+class BoundaryGeometry:
+    """
+    一份边界数据的紧凑表示：全部坐标存于一个 (N, 2) float64 缓冲区，
+    ring_offsets / polygon_offsets / feature_offsets 三级偏移数组描述 环 -> 多边形 -> 要素 的结构。
+    geojson 属性给出与原 GeoJSON 同构的只读视图，其中每个环都是坐标缓冲区上的切片 (不复制)，
+    现有按 GeoJSON 处理的函数无需改动即可使用。数组均为只读，可在会话间安全共享。
+    """
+
+    ARRAYS = ('coords', 'ring_offsets', 'polygon_offsets', 'feature_offsets', 'geometry_types')
+
+    def __init__(self, coords, ring_offsets, polygon_offsets, feature_offsets, geometry_types, properties,
+                 created_at=None):
+        self.coords = coords
+        self.ring_offsets = ring_offsets
+        self.polygon_offsets = polygon_offsets
+        self.feature_offsets = feature_offsets
+        self.geometry_types = geometry_types
+        self.properties = properties
+        self.created_at = created_at or time.time()
+        self.partial = False  # 部分地区获取失败的结果，只供本次展示，显式获取时视为未命中
+        for name in self.ARRAYS:
+            getattr(self, name).flags.writeable = False
+        self._geojson = None
+
+    @classmethod
+    def from_geojson(cls, geojson):
+        rings, ring_counts, polygon_counts, types, properties = [], [], [], [], []
+        for feature in geojson.get('features', []):
+            geometry = feature.get('geometry')
+            polygons = geometry_polygons(geometry)
+            types.append(GEOMETRY_TYPES.index(geometry['type']) if polygons else 0)
+            properties.append(feature.get('properties') or {})
+            polygon_counts.append(len(polygons))
+            for polygon in polygons:
+                ring_counts.append(len(polygon))
+                for ring in polygon:
+                    arr = np.asarray(ring, dtype=float)
+                    rings.append(arr[:, :2] if arr.ndim == 2 else np.empty((0, 2)))
+        offsets = lambda counts: np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]).astype(np.int64)
+        coords = np.ascontiguousarray(np.concatenate(rings)) if rings else np.empty((0, 2))
+        return cls(coords, offsets([len(r) for r in rings]), offsets(ring_counts), offsets(polygon_counts),
+                   np.asarray(types, dtype=np.int8), properties)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    @property
+    def geojson(self):
+        """GeoJSON 结构的只读视图 (首次访问时构建一次，环为坐标缓冲区的切片)。"""
+        if self._geojson is None:
+            ro, po, fo = self.ring_offsets, self.polygon_offsets, self.feature_offsets
+            features = []
+            for fi, props in enumerate(self.properties):
+                polygons = [[self.coords[ro[ri]:ro[ri + 1]] for ri in range(po[pi], po[pi + 1])]
+                            for pi in range(fo[fi], fo[fi + 1])]
+                geom_type = GEOMETRY_TYPES[self.geometry_types[fi]]
+                geometry = None
+                if geom_type and polygons:
+                    geometry = {'type': geom_type, 'coordinates': polygons[0] if geom_type == 'Polygon' else polygons}
+                features.append({'type': 'Feature', 'properties': props, 'geometry': geometry})
+            self._geojson = {'type': 'FeatureCollection', 'features': features}
+        return self._geojson
+
+    def save(self, path):
+        """写入目录 path (每个数组一个 .npy 文件，可内存映射加载)；先写临时目录再原子替换。"""
+        import shutil
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp_path)
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmp_path, name + ".npy"), getattr(self, name))
+        with open(os.path.join(tmp_path, "properties.json"), "w", encoding="utf-8") as f:
+            json.dump({"properties": self.properties, "created_at": self.created_at}, f, ensure_ascii=False)
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode='r' if mmap else None) for name in cls.ARRAYS]
+        with open(os.path.join(path, "properties.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        return cls(*arrays, meta["properties"], created_at=meta["created_at"])
+
+
+class GeometryStore:
+    """
+    进程级几何存储：每份边界只转换一次，所有会话共享同一个只读 BoundaryGeometry，会话中只保存键。
+    - 内存部分按总字节数做 LRU 淘汰；
+    - 可持久化到磁盘 (persist=True)，淘汰后或重启后以内存映射方式重新载入，磁盘部分同样有容量上限。
+    """
+
+    def __init__(self, store_dir=GEOMETRY_STORE_DIR, max_bytes=GEOMETRY_STORE_MAX_BYTES,
+                 disk_max_bytes=GEOMETRY_DISK_MAX_BYTES, mmap=True):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.mmap = mmap
+        self.stats = {"hits": 0, "loads": 0, "puts": 0, "evictions": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.store_dir, key) if self.store_dir else None
+
+    def get(self, key, max_age=None, complete=False):
+        """
+        返回共享的 BoundaryGeometry；不存在或早于 max_age 秒前生成时返回 None。
+        complete=True 时 (用户点击获取) 部分失败的结果也视为未命中，以便重新获取失败的地区。
+        """
+        with self._lock:
+            geometry = self._entries.get(key)
+            if geometry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+        if geometry is None:
+            path = self._path(key)
+            if not path or not os.path.isdir(path):
+                return None
+            try:
+                geometry = BoundaryGeometry.load(path, mmap=self.mmap)
+                os.utime(path)  # 刷新访问时间，用于磁盘 LRU
+            except (OSError, ValueError, KeyError):
+                return None
+            with self._lock:
+                self.stats["loads"] += 1
+                geometry = self._insert(key, geometry)
+        if max_age is not None and time.time() - geometry.created_at > max_age:
+            return None
+        if complete and geometry.partial:
             return None
+        return geometry
+
+    @perf_timed("geometry.store")
+    def put(self, key, geojson, persist=True):
+        """
+        把 GeoJSON 转为紧凑几何并登记；persist=False 时只保留在内存中，并标记为部分结果
+        (如部分地区获取失败)，get(complete=True) 不会返回它。
+        """
+        geometry = BoundaryGeometry.from_geojson(geojson)
+        geometry.partial = not persist
+        if persist and self.store_dir:
+            geometry.save(self._path(key))
+            self._evict_disk()
+            if self.mmap:
+                geometry = BoundaryGeometry.load(self._path(key), mmap=True)
+        with self._lock:
+            self.stats["puts"] += 1
+            self._entries.pop(key, None)
+            return self._insert(key, geometry)
+
+    def _insert(self, key, geometry):
+        geometry = self._entries.setdefault(key, geometry)
+        self._entries.move_to_end(key)
+        total = sum(g.nbytes for g in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            total -= evicted.nbytes
+            self.stats["evictions"] += 1
+        return geometry
+
+    def _evict_disk(self):
+        import shutil
+        entries, total = [], 0
+        for name in os.listdir(self.store_dir):
+            path = os.path.join(self.store_dir, name)
+            if not os.path.isdir(path) or ".tmp-" in name:
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+        entries.sort()
+        while total > self.disk_max_bytes and len(entries) > 1:
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+@st.cache_resource
+def get_geometry_store():
+    """进程级共享的几何存储实例。"""
+    return GeometryStore()
+
+
+# --- 批量多边形渲染 ---
+def _ring_signed_area(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * (np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def geometry_polygons(geometry):
+    """将 Polygon / MultiPolygon 统一为 [多边形[环[坐标]]] 结构，其它类型返回空列表。"""
+    if not geometry:
+        return []
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    if geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    return []
+
+
+def feature_to_path(geometry):
+    """
+    把一个要素的全部多边形 (含内环/孔洞) 合成为一条复合 Path。
+    外环统一为逆时针、内环为顺时针，配合 nonzero 填充规则即可正确镂空。
+    """
+    from matplotlib.path import Path as MplPath
+    ring_arrays = []
+    for polygon in geometry_polygons(geometry):
+        for ring_idx, ring in enumerate(polygon):
+            arr = np.asarray(ring, dtype=float)[:, :2]
+            if len(arr) < 3:
+                continue
+            ccw = _ring_signed_area(arr) > 0
+            if ccw != (ring_idx == 0):
+                arr = arr[::-1]
+            ring_arrays.append(arr)
+
+    if not ring_arrays:
+        return MplPath(np.empty((0, 2)))
+
+    # 每个环末尾追加一个 CLOSEPOLY 占位顶点
+    vertices = np.concatenate([np.vstack([arr, arr[:1]]) for arr in ring_arrays])
+    codes = np.full(len(vertices), MplPath.LINETO, dtype=MplPath.code_type)
+    start = 0
+    for arr in ring_arrays:
+        codes[start] = MplPath.MOVETO
+        start += len(arr) + 1
+        codes[start - 1] = MplPath.CLOSEPOLY
+    return MplPath(vertices, codes)
+
+
+def build_region_collection(features, values, cmap, max_val, edgecolor='#666', linewidth=0.8):
+    """
+    为全部行政区构建单个 PathCollection，按密度值逐要素着色。
+    相比逐环 add_patch，艺术家对象从数千个降为 1 个。
+    """
+    from matplotlib.collections import PathCollection
+    paths = [feature_to_path(feature.get('geometry')) for feature in features]
+    norm_values = np.asarray(values, dtype=float) / (max_val or 1) * 0.8 + 0.1
+    return PathCollection(paths, facecolors=cmap(norm_values), edgecolors=edgecolor, linewidths=linewidth)
+
+
+# --- 要素几何表 (包围盒 / 面积加权质心 / 标注锚点) ---
+def _ring_edges(rings, snap, max_edges=128):
+    """
+    把若干环转为边数组 (E, 4) = x1, y1, x2, y2。
+    先按 snap 网格吸附去除密集顶点，仍超过 max_edges 时再等间隔抽稀 (仅用于近似计算)。
+    """
+    thinned = []
+    for ring in rings:
+        if snap > 0:
+            q = np.round(ring / snap)
+            keep = np.any(q != np.roll(q, 1, axis=0), axis=1)
+            if keep.sum() >= 3:
+                ring = ring[keep]
+        thinned.append(ring)
+    stride = -(-sum(len(ring) for ring in thinned) // max_edges)
+    edges = []
+    for ring in thinned:
+        if stride > 1 and len(ring) // stride >= 3:
+            ring = ring[::stride]
+        edges.append(np.hstack([ring, np.roll(ring, -1, axis=0)]))
+    return np.concatenate(edges)
+
+
+def _inside_distance(px, py, edges):
+    """
+    批量射线法 + 点到线段距离。px/py 形状 (B, P)，edges 形状 (B, E, 4)。
+    返回带符号距离 (B, P)：内部为正，外部为负。
+    """
+    x1, y1, x2, y2 = (edges[:, None, :, k] for k in range(4))
+    px, py = px[:, :, None], py[:, :, None]
+    dx, dy = x2 - x1, y2 - y1
+    rx, ry = px - x1, py - y1
+    # 射线与边相交条件 px < x_cross，两边同乘 dy 以避免除法 (dy 为负时不等号反向)
+    crossing = ((y1 > py) != (y2 > py)) & ((rx * dy < ry * dx) == (dy > 0))
+    inside = np.count_nonzero(crossing, axis=2) % 2 == 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.clip((rx * dx + ry * dy) / (dx * dx + dy * dy), 0, 1)
+    t = np.nan_to_num(t, copy=False)
+    dist = np.sqrt(np.min((rx - t * dx) ** 2 + (ry - t * dy) ** 2, axis=2))
+    return np.where(inside, dist, -dist)
+
+
+def label_anchors(parts, grid=8, iterations=4, batch=64):
+    """
+    近似求每个多边形的"不可达极点" (离边界最远的内部点)，用作区域名称的标注锚点，凹多边形也能落在内部。
+    parts 为 [[外环, 孔洞...], ...]；采用逐级收缩的网格搜索，每一级对一批多边形的全部候选点一次性向量化求值。
+    返回 (N, 2) 数组，找不到内部点的行为 NaN。
+    """
+    n = len(parts)
+    anchors = np.full((n, 2), np.nan)
+    if not n:
+        return anchors
+    lo = np.array([part[0].min(axis=0) for part in parts])
+    hi = np.array([part[0].max(axis=0) for part in parts])
+    # 锚点只需约 2% 的精度
+    edges = [_ring_edges(part, (hi[i] - lo[i]).max() * 0.02) for i, part in enumerate(parts)]
+    order = np.argsort([len(e) for e in edges])
+    steps = np.linspace(-1, 1, grid)
+    gx, gy = (a.ravel() for a in np.meshgrid(steps, steps))
+
+    for b0 in range(0, n, batch):
+        idx = order[b0:b0 + batch]
+        width = max(len(edges[i]) for i in idx)
+        # 填充用远处的零长度边：既不与射线相交，也不会成为最近边
+        padded = np.full((len(idx), width, 4), 1e12)
+        for row, i in enumerate(idx):
+            padded[row, :len(edges[i])] = edges[i]
+        center = (lo[idx] + hi[idx]) / 2
+        half = (hi[idx] - lo[idx]) / 2
+        best = np.full((len(idx), 2), np.nan)
+        best_d = np.zeros(len(idx))
+        for _ in range(iterations):
+            px = center[:, :1] + gx[None, :] * half[:, :1]
+            py = center[:, 1:] + gy[None, :] * half[:, 1:]
+            d = _inside_distance(px, py, padded)
+            k = np.argmax(d, axis=1)
+            dk = d[np.arange(len(idx)), k]
+            better = dk > best_d
+            best[better] = np.column_stack([px[better, k[better]], py[better, k[better]]])
+            best_d[better] = dk[better]
+            center = np.where(np.isnan(best), center, best)
+            half = half * 4 / (grid - 1)
+        anchors[idx] = best
+    return anchors
+
+
+@perf_timed("geometry.features")
+def build_feature_table(geojson):
+    """
+    为 GeoJSON 中的每个要素一次性计算几何属性，返回按要素顺序排列的 DataFrame：
+    name, minx/miny/maxx/maxy (包围盒), area, centroid_x/y (全部部件的面积加权质心，已扣除孔洞),
+    label_x/y (最大部件的不可达极点), center_x/y (优先使用属性中的 center，否则为质心)。
+    非面要素对应行的数值为 NaN。
+    """
+    features = geojson.get('features', [])
+    n = len(features)
+    ring_arrays, ring_feature, ring_part, ring_is_hole = [], [], [], []
+    part_count = 0
+    for fi, feature in enumerate(features):
+        for polygon in geometry_polygons(feature.get('geometry')):
+            for ri, ring in enumerate(polygon):
+                arr = np.asarray(ring, dtype=float)[:, :2]
+                if len(arr) < 3:
+                    continue
+                ring_arrays.append(arr)
+                ring_feature.append(fi)
+                ring_part.append(part_count)
+                ring_is_hole.append(ri > 0)
+            part_count += 1
+
+    props = [feature.get('properties') or {} for feature in features]
+    table = pd.DataFrame({'name': [p.get('name') for p in props]})
+    cols = ['minx', 'miny', 'maxx', 'maxy', 'area', 'centroid_x', 'centroid_y', 'label_x', 'label_y']
+    for col in cols:
+        table[col] = np.nan
+    if ring_arrays:
+        ring_feature = np.asarray(ring_feature)
+        ring_part = np.asarray(ring_part)
+        lengths = np.array([len(r) for r in ring_arrays])
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        pts = np.concatenate(ring_arrays)
+        rid = np.repeat(np.arange(len(ring_arrays)), lengths)
+        nxt = np.arange(len(pts)) + 1
+        nxt[offsets[1:] - 1] = offsets[:-1]
+        x, y, xn, yn = pts[:, 0], pts[:, 1], pts[nxt, 0], pts[nxt, 1]
+
+        # 鞋带公式：逐环求有向面积与质心，外环取正、孔洞取负
+        cross = x * yn - xn * y
+        a2 = np.bincount(rid, cross)
+        sx = np.bincount(rid, (x + xn) * cross)
+        sy = np.bincount(rid, (y + yn) * cross)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ring_cx, ring_cy = sx / (3 * a2), sy / (3 * a2)
+        ring_area = np.abs(a2) / 2 * np.where(ring_is_hole, -1, 1)
+        ring_cx = np.nan_to_num(ring_cx)
+        ring_cy = np.nan_to_num(ring_cy)
+
+        area = np.bincount(ring_feature, ring_area, minlength=n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centroid_x = np.bincount(ring_feature, ring_area * ring_cx, minlength=n) / area
+            centroid_y = np.bincount(ring_feature, ring_area * ring_cy, minlength=n) / area
+
+        bbox = np.full((n, 4), np.nan)
+        ring_min = np.minimum.reduceat(pts, offsets[:-1])
+        ring_max = np.maximum.reduceat(pts, offsets[:-1])
+        has_geom = np.bincount(ring_feature, minlength=n) > 0
+        bbox[has_geom, :2] = np.inf
+        bbox[has_geom, 2:] = -np.inf
+        np.fmin.at(bbox[:, 0], ring_feature, ring_min[:, 0])
+        np.fmin.at(bbox[:, 1], ring_feature, ring_min[:, 1])
+        np.fmax.at(bbox[:, 2], ring_feature, ring_max[:, 0])
+        np.fmax.at(bbox[:, 3], ring_feature, ring_max[:, 1])
+
+        # 标注锚点：取每个要素面积最大的部件 (含其孔洞) 求不可达极点
+        part_area = np.bincount(ring_part, ring_area, minlength=part_count)
+        part_feature = np.full(part_count, -1)
+        part_feature[ring_part] = ring_feature
+        largest = {}
+        for part in np.argsort(part_area):
+            if part_feature[part] >= 0:
+                largest[part_feature[part]] = part
+        part_rings = {}
+        for r, part in enumerate(ring_part):
+            part_rings.setdefault(part, []).append(ring_arrays[r])
+        label_features = np.array(sorted(largest), dtype=int)
+        label = np.column_stack([centroid_x, centroid_y])
+        anchors = label_anchors([part_rings[largest[fi]] for fi in label_features])
+        found = ~np.isnan(anchors[:, 0])
+        label[label_features[found]] = anchors[found]
+
+        table[['minx', 'miny', 'maxx', 'maxy']] = bbox
+        table['area'] = np.where(has_geom, area, np.nan)
+        table['centroid_x'] = np.where(has_geom, centroid_x, np.nan)
+        table['centroid_y'] = np.where(has_geom, centroid_y, np.nan)
+        table[['label_x', 'label_y']] = label
+
+    center = np.array([p.get('center') if p.get('center') else (np.nan, np.nan) for p in props],
+                      dtype=float).reshape(n, 2)
+    table['center_x'] = np.where(np.isnan(center[:, 0]), table['centroid_x'], center[:, 0])
+    table['center_y'] = np.where(np.isnan(center[:, 1]), table['centroid_y'], center[:, 1])
+    return table
+
+
+def table_bounds(table):
+    """全部要素的总包围盒 (minx, miny, maxx, maxy)，没有面要素时返回 None。"""
+    if table['minx'].isna().all():
+        return None
+    return table['minx'].min(), table['miny'].min(), table['maxx'].max(), table['maxy'].max()
+
+
+@st.cache_resource(max_entries=32)
+def get_feature_table(cache_key, _geojson):
+    """按区域键缓存的要素几何表，每份 GeoJSON 只计算一次。"""
+    return build_feature_table(_geojson)
+
+
+# --- 空间连接 (点落区) ---
+@perf_timed("geometry.edges")
+def feature_edges(geojson):
+    """每个要素全部环 (含孔洞与多部件) 的边数组列表，元素形状为 (E, 4) = x1, y1, x2, y2。"""
+    edges = []
+    for feature in geojson.get('features', []):
+        parts = []
+        for polygon in geometry_polygons(feature.get('geometry')):
+            for ring in polygon:
+                arr = np.asarray(ring, dtype=float)[:, :2]
+                if len(arr) >= 3:
+                    parts.append(np.hstack([arr, np.roll(arr, -1, axis=0)]))
+        edges.append(np.concatenate(parts) if parts else np.empty((0, 4)))
+    return edges
+
+
+def _points_in_edges(px, py, edges):
+    """
+    射线法判断点是否在多边形内 (奇偶规则，天然支持孔洞与多部件)。
+    点按纬度排序后，每条边只与纬度落在其跨度内的点配对 (searchsorted)，
+    因此计算量约为 点数 × 穿过同一水平线的边数，而不是 点数 × 总边数。
+    """
+    order = np.argsort(py, kind='stable')
+    ys = py[order]
+    ymin = np.minimum(edges[:, 1], edges[:, 3])
+    ymax = np.maximum(edges[:, 1], edges[:, 3])
+    lo = np.searchsorted(ys, ymin, side='left')
+    hi = np.searchsorted(ys, ymax, side='left')
+    counts = hi - lo
+    total = int(counts.sum())
+    inside = np.zeros(len(px), dtype=bool)
+    if total == 0:
+        return inside
+    edge_idx = np.repeat(np.arange(len(edges)), counts)
+    pos = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    x1, y1, x2, y2 = edges[edge_idx].T
+    pidx = order[pos]
+    x_cross = x1 + (py[pidx] - y1) * (x2 - x1) / (y2 - y1)
+    crossings = np.bincount(pidx[px[pidx] < x_cross], minlength=len(px))
+    inside[:] = crossings % 2 == 1
+    return inside
+
+
+@perf_timed("geometry.join")
+def spatial_join(xs, ys, edges, table, cells_per_feature=4):
+    """
+    把每个点分配到所在的要素，返回要素下标数组 (不在任何要素内为 -1)。
+    edges 为 feature_edges() 的结果，table 为要素几何表 (提供包围盒)。
+    点先分入均匀网格并按格排序，每个要素只取其包围盒覆盖网格行中的连续点段，
+    再经包围盒过滤后做向量化射线法判断。
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    result = np.full(len(xs), -1, dtype=np.int64)
+    bounds = table_bounds(table)
+    if bounds is None or not len(xs):
+        return result
+    minx, miny, maxx, maxy = bounds
+    valid = np.isfinite(xs) & np.isfinite(ys) & (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)
+
+    n_cells = max(len(table) * cells_per_feature, 1)
+    aspect = (maxx - minx) / max(maxy - miny, 1e-12)
+    nx = max(int(np.sqrt(n_cells * aspect)), 1)
+    ny = max(int(n_cells / nx), 1)
+    cw, ch = max((maxx - minx) / nx, 1e-12), max((maxy - miny) / ny, 1e-12)
+
+    idx = np.flatnonzero(valid)
+    cx = np.clip(((xs[idx] - minx) / cw).astype(np.int64), 0, nx - 1)
+    cy = np.clip(((ys[idx] - miny) / ch).astype(np.int64), 0, ny - 1)
+    cell = cy * nx + cx
+    order = np.argsort(cell, kind='stable')
+    sorted_idx = idx[order]
+    cell_start = np.searchsorted(cell[order], np.arange(nx * ny + 1))
+
+    boxes = table[['minx', 'miny', 'maxx', 'maxy']].to_numpy()
+    for fi, (bx0, by0, bx1, by1) in enumerate(boxes):
+        if np.isnan(bx0) or not len(edges[fi]):
+            continue
+        c0, c1 = int((bx0 - minx) // cw), min(int((bx1 - minx) // cw), nx - 1)
+        r0, r1 = int((by0 - miny) // ch), min(int((by1 - miny) // ch), ny - 1)
+        segments = [sorted_idx[cell_start[r * nx + c0]:cell_start[r * nx + c1 + 1]] for r in range(r0, r1 + 1)]
+        cand = np.concatenate(segments) if segments else np.empty(0, dtype=np.int64)
+        cand = cand[result[cand] < 0]
+        px, py = xs[cand], ys[cand]
+        in_box = (px >= bx0) & (px <= bx1) & (py >= by0) & (py <= by1)
+        cand, px, py = cand[in_box], px[in_box], py[in_box]
+        if len(cand):
+            result[cand[_points_in_edges(px, py, edges[fi])]] = fi
+    return result
+
+
+def aggregate_by_feature(feature_idx, n_features, values=None, how='count'):
+    """按要素汇总点位：count 计数，sum / mean 对 values 求和 / 均值 (无点位的要素均值为 0)。"""
+    inside = feature_idx >= 0
+    counts = np.bincount(feature_idx[inside], minlength=n_features).astype(float)
+    if how == 'count' or values is None:
+        return counts
+    sums = np.bincount(feature_idx[inside], weights=np.asarray(values, dtype=float)[inside], minlength=n_features)
+    if how == 'sum':
+        return sums
+    return np.divide(sums, counts, out=np.zeros(n_features), where=counts > 0)
+
+
+@st.cache_resource(max_entries=32)
+def get_feature_edges(cache_key, _geojson):
+    """按区域键缓存的要素边数组。"""
+    return feature_edges(_geojson)
+
+
+@st.cache_resource(max_entries=16)
+def get_district_values(cache_key, points_key, how, value_col, _geojson, _points_df, lon_col, lat_col):
+    """空间连接并按区域汇总，返回 {区域名称: 数值}；按 (区域键, 点位数据键, 指标) 缓存。"""
+    table = get_feature_table(cache_key, _geojson)
+    joined = spatial_join(_points_df[lon_col].to_numpy(), _points_df[lat_col].to_numpy(),
+                          get_feature_edges(cache_key, _geojson), table)
+    values = _points_df[value_col].to_numpy() if value_col else None
+    agg = aggregate_by_feature(joined, len(table), values, how)
+    return {name: value for name, value in zip(table['name'], agg) if name is not None}
+
+
+# --- 模拟爬取 (向量化合成点位) ---
+CRAWL_BRANDS = ['安能', '中通', '顺丰', '京东', '圆通']
+CRAWL_SUFFIXES = ["物流有限公司", "供应链管理公司", "配送中心", "分拣站", "转运中心"]
+CRAWL_SPREAD = 0.03  # 点位围绕区域中心的标准差 (度)
+CRAWL_MAX_POINTS = 2_000_000  # 单次模拟的总点位上限 (结果按进程缓存，过大会耗尽共享服务的内存)
+
+
+def _categorical(labels, codes):
+    """由 (可能重复的) 标签数组与编码构造 Categorical，重复标签合并为同一类别。"""
+    remap, categories = pd.factorize(np.asarray(labels, dtype=object))
+    return pd.Categorical.from_codes(remap[codes], categories=categories)
+
+
+@perf_timed("geometry.crawl")
+def simulate_crawl(table, rates=None, seed=None, spread=CRAWL_SPREAD, edges=None, max_rounds=8,
+                   max_points=CRAWL_MAX_POINTS):
+    """
+    按区域批量生成模拟的企业点位，所有列一次性按数组生成，可扩展到数百万点。
+    - table：要素几何表，点位以 center_x / center_y 为中心按正态分布散布；
+    - rates：每区点位数的期望 (标量、与 table 对齐的数组或 {区域名: 期望} 字典)，按泊松分布抽样；
+      为 None 时沿用原规则，每区均匀抽取 1~15 个；
+    - seed：随机种子，相同种子与输入得到完全相同的结果；
+    - edges：传入 feature_edges() 的结果时，把点位限定在所属区域多边形内
+      (落在区域外的点重新抽样，max_rounds 轮后仍在外的点放到该区的标注锚点)；
+    - max_points：总点位期望的上限，超过时在抽样前抛出 ValueError。
+    返回 (点位 DataFrame, 每个要素的点数数组)。
+    """
+    rng = np.random.default_rng(seed)
+    names = table['name'].fillna('未知区域').to_numpy(dtype=object)
+    cx = table['center_x'].to_numpy(dtype=float)
+    cy = table['center_y'].to_numpy(dtype=float)
+    valid = np.isfinite(cx) & np.isfinite(cy)
+
+    if rates is None:
+        counts = rng.integers(1, 16, len(table))
+    else:
+        if isinstance(rates, dict):
+            rates = [rates.get(name, 0) for name in names]
+        rates = np.broadcast_to(np.asarray(rates, dtype=float), len(table))
+        expected = float(rates[valid].sum())
+        if expected > max_points:
+            raise ValueError(f"模拟点位总数期望为 {expected:,.0f}，超过上限 {max_points:,}，请降低每区平均点位数")
+        counts = rng.poisson(rates)
+    counts = np.where(valid, counts, 0).astype(np.int64)
+
+    idx = np.repeat(np.arange(len(table)), counts)
+    n = len(idx)
+    lon = cx[idx] + rng.normal(0, spread, n)
+    lat = cy[idx] + rng.normal(0, spread, n)
+
+    if edges is not None and n:
+        outside = np.flatnonzero(spatial_join(lon, lat, edges, table) != idx)
+        for _ in range(max_rounds):
+            if not len(outside):
+                break
+            lon[outside] = cx[idx[outside]] + rng.normal(0, spread, len(outside))
+            lat[outside] = cy[idx[outside]] + rng.normal(0, spread, len(outside))
+            still = spatial_join(lon[outside], lat[outside], edges, table) != idx[outside]
+            outside = outside[still]
+        if len(outside):
+            lon[outside] = table['label_x'].to_numpy(dtype=float)[idx[outside]]
+            lat[outside] = table['label_y'].to_numpy(dtype=float)[idx[outside]]
+
+    # 公司名称：区域 + 品牌 + 后缀；每区第 1, 4, 7... 个为 "区域第 i 分拨站"。
+    # 先算整数编码，只为实际出现的编码拼接字符串。
+    rank = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+    combo = rng.integers(0, len(CRAWL_BRANDS), n) * len(CRAWL_SUFFIXES) + rng.integers(0, len(CRAWL_SUFFIXES), n)
+    n_combo = len(CRAWL_BRANDS) * len(CRAWL_SUFFIXES)
+    n_regular = len(table) * n_combo
+    max_rank = int(counts.max()) if len(counts) else 0
+    code = np.where(rank % 3 == 0, n_regular + idx * max_rank + rank, idx * n_combo + combo)
+    unique_codes, inverse = np.unique(code, return_inverse=True)
+    station = unique_codes >= n_regular
+    district, c = np.divmod(unique_codes[~station], n_combo)
+    brands = np.array(CRAWL_BRANDS, dtype=object)
+    suffixes = np.array(CRAWL_SUFFIXES, dtype=object)
+    labels = np.empty(len(unique_codes), dtype=object)
+    labels[~station] = names[district] + brands[c // len(CRAWL_SUFFIXES)] + suffixes[c % len(CRAWL_SUFFIXES)]
+    district, r = np.divmod(unique_codes[station] - n_regular, max(max_rank, 1))
+    labels[station] = names[district] + "第" + (r + 1).astype(str).astype(object) + "分拨站"
+
+    df = pd.DataFrame({
+        '公司名称': _categorical(labels, inverse),
+        '区域': _categorical(names, idx),
+        '纬度': lat,
+        '经度': lon,
+        '类型': pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), categories=['站点']),
+    })
+    return df, counts
+
+
+@st.cache_resource(max_entries=16)
+def get_simulated_crawl(cache_key, seed, rate, inside, _geometry):
+    """按 (区域键, 参数) 缓存的模拟爬取结果与区域计数，同一份边界与参数的会话共享同一份点位。"""
+    geojson = _geometry.geojson
+    table = get_feature_table(cache_key, geojson)
+    df, counts = simulate_crawl(table, rates=rate or None, seed=seed,
+                                edges=get_feature_edges(cache_key, geojson) if inside else None)
+    density_map = (pd.Series(counts, index=table['name'].fillna('未知区域'))
+                   .groupby(level=0).sum().to_dict())
+    return df, density_map
+
+
+# --- 几何简化 (Level of Detail) ---
+SIMPLIFY_PIXEL_FRACTION = 1.0  # 简化容差 = 导出分辨率下 1 像素 (远小于 0.8pt 描边宽度)
+
+
+def simplify_tolerance(bounds, figsize=(10, 8), dpi=300, pixel_fraction=SIMPLIFY_PIXEL_FRACTION):
+    """按等比例地图在 figsize×dpi 画布上的尺度，计算不可见误差对应的坐标容差。"""
+    minx, miny, maxx, maxy = bounds
+    units_per_px = max((maxx - minx) / (figsize[0] * dpi), (maxy - miny) / (figsize[1] * dpi))
+    if units_per_px <= 0:
+        return 0.0
+    # 保留两位有效数字，使范围的细微差异仍能命中缓存
+    return float(f"{units_per_px * pixel_fraction:.2g}")
+
+
+def _douglas_peucker_mask(pts, tolerance):
+    """迭代式 Douglas-Peucker，距离计算向量化；返回保留点的布尔掩码 (首尾恒保留)。"""
+    n = len(pts)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a, b = pts[start], pts[end]
+        seg = pts[start + 1:end] - a
+        d = b - a
+        length = np.hypot(d[0], d[1])
+        if length == 0:
+            dist = np.hypot(seg[:, 0], seg[:, 1])
+        else:
+            dist = np.abs(d[0] * seg[:, 1] - d[1] * seg[:, 0]) / length
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            k = start + 1 + i
+            keep[k] = True
+            stack.append((start, k))
+            stack.append((k, end))
+    return keep
+
+
+@perf_timed("geometry.simplify")
+def simplify_geojson(geojson, tolerance):
+    """
+    拓扑保持的 GeoJSON 简化。
+    先把所有环拆分为以节点 (多个区域交汇处) 为端点的弧段，每条共享弧只简化一次，
+    相邻区域使用完全相同的结果，因此公共边界不会出现缝隙或重叠。
+    """
+    features = geojson.get('features', [])
+    if tolerance <= 0 or not features:
+        return geojson
+
+    rings, ring_owner = [], []
+    for fi, feature in enumerate(features):
+        for pi, polygon in enumerate(geometry_polygons(feature.get('geometry'))):
+            for ri, ring in enumerate(polygon):
+                arr = np.asarray(ring, dtype=float)[:, :2]
+                if len(arr) > 1 and np.array_equal(arr[0], arr[-1]):
+                    arr = arr[:-1]
+                if len(arr) < 3:
+                    continue
+                rings.append(arr)
+                ring_owner.append((fi, pi, ri))
+    if not rings:
+        return geojson
+
+    lengths = np.array([len(r) for r in rings])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    all_pts = np.concatenate(rings)
+    ring_ids = np.repeat(np.arange(len(rings)), lengths)
+
+    # 坐标量化后作为点的全局编号 (约 1 cm 精度)
+    q = np.round(all_pts * 1e7).astype(np.int64)
+    _, pid = np.unique((q[:, 0] << 32) ^ (q[:, 1] & 0xFFFFFFFF), return_inverse=True)
+    n_points = pid.max() + 1
+
+    # 每个点所属环集合的签名 (个数、编号和、编号平方和)
+    pairs = np.unique(pid * len(rings) + ring_ids)
+    pair_pid, pair_ring = pairs // len(rings), (pairs % len(rings)).astype(float)
+    sig = np.stack([np.bincount(pair_pid, minlength=n_points),
+                    np.bincount(pair_pid, weights=pair_ring, minlength=n_points),
+                    np.bincount(pair_pid, weights=pair_ring ** 2, minlength=n_points)], axis=1)[pid]
+
+    # 与前后邻点签名不同的点即为节点 (junction)
+    local = np.arange(len(all_pts)) - offsets[ring_ids]
+    prev_idx = np.where(local == 0, offsets[ring_ids + 1] - 1, np.arange(len(all_pts)) - 1)
+    next_idx = np.where(local == lengths[ring_ids] - 1, offsets[ring_ids], np.arange(len(all_pts)) + 1)
+    junction = np.any(sig != sig[prev_idx], axis=1) | np.any(sig != sig[next_idx], axis=1)
+
+    arc_cache = {}
+
+    def simplify_arc(idx):
+        ids = pid[idx]
+        forward = (ids[0], ids[1]) <= (ids[-1], ids[-2])
+        key = (ids[0], ids[1], ids[-1], len(ids)) if forward else (ids[-1], ids[-2], ids[0], len(ids))
+        if key not in arc_cache:
+            canon = idx if forward else idx[::-1]
+            arc_cache[key] = _douglas_peucker_mask(all_pts[canon], tolerance)
+        mask = arc_cache[key]
+        return idx[mask if forward else mask[::-1]]
+
+    new_rings = []
+    for r, arr in enumerate(rings):
+        start, n = offsets[r], lengths[r]
+        idx = np.arange(start, start + n)
+        j = np.flatnonzero(junction[idx])
+        if len(j) == 0:
+            # 无节点的闭合环：以编号最小的点为规范起点，并按邻点编号统一方向
+            s = int(np.argmin(pid[idx]))
+            idx = np.roll(idx, -s)
+            if pid[idx[1]] > pid[idx[-1]]:
+                idx = np.concatenate([idx[:1], idx[1:][::-1]])
+            far = int(np.argmax(np.hypot(*(all_pts[idx] - all_pts[idx[0]]).T)))
+            j = np.array([0, far]) if far > 0 else np.array([0])
+        idx = np.roll(idx, -j[0])
+        j = np.concatenate([j - j[0], [n]])
+        loop = np.concatenate([idx, idx[:1]])
+        kept = [simplify_arc(loop[a:b + 1])[:-1] for a, b in zip(j[:-1], j[1:]) if b > a]
+        kept = np.concatenate(kept) if kept else idx
+        new_ring = all_pts[kept] if len(kept) >= 3 else arr
+        new_rings.append(np.vstack([new_ring, new_ring[:1]]).tolist())
+
+    # 按原结构回填，不修改输入对象
+    rebuilt = {}
+    for (fi, pi, ri), ring in zip(ring_owner, new_rings):
+        rebuilt.setdefault(fi, {}).setdefault(pi, []).append(ring)
+
+    new_features = []
+    for fi, feature in enumerate(features):
+        geometry = feature.get('geometry')
+        if fi not in rebuilt:
+            new_features.append(feature)
+            continue
+        polygons = [rebuilt[fi][pi] for pi in sorted(rebuilt[fi])]
+        if geometry['type'] == 'Polygon':
+            new_geometry = {'type': 'Polygon', 'coordinates': polygons[0]}
+        else:
+            new_geometry = {'type': 'MultiPolygon', 'coordinates': polygons}
+        new_features.append({**feature, 'geometry': new_geometry})
+    return {**geojson, 'features': new_features}
+
+
+@st.cache_resource(max_entries=32)
+def _simplified_geojson(cache_key, tolerance, _geojson):
+    return simplify_geojson(_geojson, tolerance)
+
+
+def simplify_for_figure(cache_key, geojson, figsize=(10, 8), dpi=300):
+    """按画布尺寸与导出 DPI 计算容差并返回简化后的 GeoJSON，结果按 (区域键, 容差) 缓存。"""
+    bounds = table_bounds(get_feature_table(cache_key, geojson))
+    if bounds is None:
+        return geojson
+    return _simplified_geojson(cache_key, simplify_tolerance(bounds, figsize, dpi), geojson)
+
+
+# --- 点位标注避让 (Label Placement) ---
+# 候选方位：(x 方向, y 方向, ha, va)，依次尝试上、下、右、左
+LABEL_POSITIONS = ((0, 1, 'center', 'bottom'), (0, -1, 'center', 'top'),
+                   (1, 0, 'left', 'center'), (-1, 0, 'right', 'center'))
+
+
+def _label_width_pt(text, fontsize):
+    """估算文字宽度 (磅)：全角字符约 1em，半角约 0.65em，另留少量间距。"""
+    return sum(0.65 if ord(c) < 128 else 1.0 for c in text) * fontsize * 1.1 + 1.0
+
+
+def place_point_labels(ax, xs, ys, texts, budget=50, priority=None, fontsize=7, pad=3.0, **text_kwargs):
+    """
+    在显示坐标中贪心放置点位标注，避免相互重叠。
+    - 先用网格空间索引在每个标注大小的格子里只保留优先级最高的候选点 (向量化)；
+    - 再按优先级依次尝试 4 个方位，与已放置标注做碰撞检测，直到达到 budget 上限。
+    priority 越大越优先；未提供时优先标注周围点位稀疏的点，结果与行顺序无关。
+    需在坐标范围确定 (autoscale / set_aspect) 之后调用，返回实际放置的标注数。
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    texts = np.asarray(texts, dtype=str)
+    if budget <= 0 or not len(xs):
+        return 0
+
+    fig = ax.figure
+    # autoscale() 只把视图范围标记为过期，读取一次范围才会重新计算；
+    # 只靠 apply_aspect() 时，默认 'auto' 纵横比下 transData 仍停留在旧范围
+    ax.get_xlim()
+    ax.get_ylim()
+    ax.apply_aspect()
+    to_pt = 72.0 / fig.dpi
+    pts = ax.transData.transform(np.column_stack([xs, ys])) * to_pt
+    x0, y0, x1, y1 = ax.bbox.extents * to_pt
+    valid = np.isfinite(pts).all(axis=1) & (pts[:, 0] >= x0) & (pts[:, 0] <= x1) & (pts[:, 1] >= y0) & (pts[:, 1] <= y1)
+
+    cell_w, cell_h = fontsize * 6.0, fontsize * 1.4
+    cx = np.floor((pts[:, 0] - x0) / cell_w).astype(np.int64)
+    cy = np.floor((pts[:, 1] - y0) / cell_h).astype(np.int64)
+    cell = np.where(valid, cx * 1_000_003 + cy, -1)
+
+    if priority is None:
+        _, inverse, counts = np.unique(cell, return_inverse=True, return_counts=True)
+        priority = -counts[inverse]
+    priority = np.asarray(priority, dtype=float)
+
+    # 按 (优先级降序, 文本, 坐标) 排序，保证结果确定
+    order = np.lexsort((ys, xs, texts, -priority))
+    order = order[valid[order]]
+    _, first = np.unique(cell[order], return_index=True)
+    candidates = order[np.sort(first)]
+
+    occupied = {}
+    placed = 0
+    label_h = fontsize * 1.2
+    for i in candidates:
+        px, py = pts[i]
+        w = _label_width_pt(texts[i], fontsize)
+        for dx, dy, ha, va in LABEL_POSITIONS:
+            left = px + dx * pad - (w / 2 if dx == 0 else (w if dx < 0 else 0))
+            bottom = py + dy * pad - (label_h / 2 if dy == 0 else (label_h if dy < 0 else 0))
+            box = (left, bottom, left + w, bottom + label_h)
+            if box[0] < x0 or box[2] > x1 or box[1] < y0 or box[3] > y1:
+                continue
+            keys = [(gx, gy)
+                    for gx in range(int((box[0] - x0) // cell_w), int((box[2] - x0) // cell_w) + 1)
+                    for gy in range(int((box[1] - y0) // cell_h), int((box[3] - y0) // cell_h) + 1)]
+            if any(b[0] < box[2] and box[0] < b[2] and b[1] < box[3] and box[1] < b[3]
+                   for key in keys for b in occupied.get(key, ())):
+                continue
+            for key in keys:
+                occupied.setdefault(key, []).append(box)
+            ax.annotate(texts[i], (xs[i], ys[i]), xytext=(dx * pad, dy * pad), textcoords='offset points',
+                        ha=ha, va=va, fontsize=fontsize, **text_kwargs)
+            placed += 1
+            break
+        if placed >= budget:
+            break
+    return placed
+
+
+# --- 渲染结果缓存与延迟导出 ---
+RENDER_FIGSIZE = (10, 8)
+PREVIEW_DPI = 150
+EXPORT_DPI = 300
+RENDER_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 渲染缓存 (含其引用的源数据) 的估算上限
+_RENDER_LOCK = threading.Lock()  # Matplotlib / seaborn 的全局状态不是线程安全的
+
+
+@perf_timed("fingerprint")
+def data_fingerprint(df):
+    """
+    DataFrame 内容指纹 (列名、类型与逐行哈希)，用于渲染缓存键。
+    需要逐行扫描整个表，页面中改用数据来源的内容哈希，这里只供批量渲染等没有现成哈希的场景。
+    """
+    if df is None:
+        return None
+    h = hashlib.sha1(repr(list(zip(df.columns, df.dtypes.astype(str)))).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+
+def render_key(*parts):
+    """把数据指纹、图表类型与全部样式参数合成一个缓存键。"""
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+class RenderResult:
+    """
+    一次绘图的缓存结果。draw(fig, ax) 是无副作用的绘图函数：
+    预览 PNG 立即生成；PNG/SVG 导出在首次下载时才重新绘制生成并缓存。
+    每次绘制使用独立的 Figure (不进入 pyplot 的全局注册表)，用完即释放。
+    """
+
+    def __init__(self, draw):
+        self._draw = draw
+        self._exports = {}
+        self._lock = threading.Lock()
+        self.preview_png = self._render('png', PREVIEW_DPI)
+
+    def _render(self, fmt, dpi):
+        from matplotlib.figure import Figure
+        with _RENDER_LOCK:
+            fig = Figure(figsize=RENDER_FIGSIZE)
+            try:
+                with perf_stage("draw"):
+                    self._draw(fig, fig.subplots())
+                buf = io.BytesIO()
+                with perf_stage("export", format=fmt, dpi=dpi):
+                    fig.savefig(buf, format=fmt, dpi=dpi, bbox_inches='tight')
+                return buf.getvalue()
+            finally:
+                fig.clear()
+
+    @property
+    def nbytes(self):
+        """已生成图片的字节数 (不加锁读取快照，导出进行中时略有滞后)。"""
+        return len(self.preview_png) + sum(len(b) for b in list(self._exports.values()))
+
+    def export(self, fmt):
+        with self._lock:
+            if fmt not in self._exports:
+                self._exports[fmt] = self._render(fmt, EXPORT_DPI)
+            return self._exports[fmt]
+
+
+def _pinned_nbytes(obj):
+    """估算被渲染结果引用 (因而不能释放) 的数据大小：DataFrame 按列缓冲区，几何 / 数组按 nbytes。"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True).sum())
+    return int(getattr(obj, "nbytes", 0) or 0)
+
+
+class RenderCache:
+    """
+    进程级 LRU 渲染缓存：相同键直接复用预览与导出结果。
+    结果中的 draw 闭包 (供导出时重绘) 会引用源数据，因此除条目数外还按估算大小淘汰：
+    已生成的图片字节 + 各条目引用的数据 (pinned，同一对象只计一次)。最近使用的条目总是保留。
+    """
+
+    def __init__(self, max_entries=16, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def nbytes(self):
+        """当前估算占用：图片字节与被引用数据之和。"""
+        pinned = {}
+        total = 0
+        for result, objs in self._entries.values():
+            total += result.nbytes
+            for obj in objs:
+                pinned[id(obj)] = obj
+        return total + sum(_pinned_nbytes(obj) for obj in pinned.values())
+
+    def get(self, key, draw, pinned=()):
+        """pinned 为 draw 闭包引用的大对象 (数据表、几何)，用于估算缓存大小。"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._entries[key][0]
+        result = RenderResult(draw)
+        with self._lock:
+            self._entries[key] = (result, tuple(o for o in pinned if o is not None))
+            self.stats["misses"] += 1
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.nbytes() > self.max_bytes):
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return result
+
+
+@st.cache_resource
+def get_render_cache():
+    """进程级共享的渲染缓存实例。"""
+    return RenderCache()
+
+
+# --- 大规模点位的密度聚合渲染 ---
+POINT_AGGREGATE_THRESHOLD = 50_000  # "自动" 模式下超过该点数即改为聚合栅格
+AGGREGATE_BIN_PX = 3  # 每个栅格单元在导出分辨率下占用的像素数
+POINT_RENDER_MODES = ["自动", "全部点位", "聚合栅格"]
+
+
+def use_point_aggregation(mode, n_points):
+    """根据渲染方式与点数决定是否聚合。"""
+    return mode == "聚合栅格" or (mode == "自动" and n_points > POINT_AGGREGATE_THRESHOLD)
+
+
+def draw_point_density(ax, xs, ys, extent=None, equal_bins=False, bin_px=AGGREGATE_BIN_PX, dpi=EXPORT_DPI,
+                       cmap='YlOrRd', **imshow_kwargs):
+    """
+    把任意数量的点按输出分辨率分箱计数，并作为单个图像图层绘制 (计数为 0 的格子透明，颜色取对数刻度)。
+    栅格尺寸只取决于坐标轴在导出时的像素大小，因此绘制与导出 (含 SVG) 的开销与点数无关。
+    equal_bins=True 时格子在数据坐标中为正方形，适用于等比例的地图。返回 AxesImage。
+    """
+    from matplotlib.colors import LogNorm
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    ok = np.isfinite(xs) & np.isfinite(ys)
+    xs, ys = xs[ok], ys[ok]
+    if extent is None:
+        extent = (xs.min(), xs.max(), ys.min(), ys.max()) if len(xs) else (0.0, 1.0, 0.0, 1.0)
+    x0, x1, y0, y1 = extent
+    if x1 <= x0:
+        x0, x1 = x0 - 0.5, x1 + 0.5
+    if y1 <= y0:
+        y0, y1 = y0 - 0.5, y1 + 0.5
+
+    fig = ax.figure
+    pos = ax.get_position()
+    nx = max(int(pos.width * fig.get_figwidth() * dpi / bin_px), 1)
+    ny = max(int(pos.height * fig.get_figheight() * dpi / bin_px), 1)
+    if equal_bins:
+        step = max((x1 - x0) / nx, (y1 - y0) / ny)
+        nx = max(int(np.ceil((x1 - x0) / step)), 1)
+        ny = max(int(np.ceil((y1 - y0) / step)), 1)
+        x1, y1 = x0 + nx * step, y0 + ny * step
+
+    ix = np.clip(((xs - x0) / (x1 - x0) * nx).astype(np.int64), 0, nx - 1)
+    iy = np.clip(((ys - y0) / (y1 - y0) * ny).astype(np.int64), 0, ny - 1)
+    counts = np.bincount(iy * nx + ix, minlength=nx * ny).reshape(ny, nx)
+    image = np.ma.masked_equal(counts, 0)
+    return ax.imshow(image, extent=(x0, x1, y0, y1), origin='lower', cmap=cmap, interpolation='nearest',
+                     norm=LogNorm(vmin=1, vmax=max(counts.max(), 1)), aspect='auto', **imshow_kwargs)
+
+
+# --- 字体处理核心逻辑 ---
+FONT_CACHE_DIR = os.environ.get("ACADEMICVIZ_FONT_DIR",
+                                os.path.join(os.path.expanduser("~"), ".cache", "academicviz", "fonts"))
+FONT_DOWNLOAD_URL = "https://github.com/StellarCN/scp_zh/raw/master/fonts/SimHei.ttf"  # 使用一个稳定的字体源
+FONT_DOWNLOAD_TIMEOUT = (5, 15)  # (连接, 两次读取之间) 超时
+FONT_DOWNLOAD_DEADLINE = 60  # 整个下载的时间上限 (秒)
+FONT_RETRY_AFTER = 24 * 3600  # 下载失败后，一天内不再重试 (离线环境不反复等待超时)
+COMMON_CN_FONTS = ['SimHei', 'Microsoft YaHei', 'PingFang SC', 'Heiti TC', 'WenQuanYi Micro Hei',
+                   'Noto Sans CJK SC', 'Source Han Sans SC']
+
+
+class FontBootstrap:
+    """
+    在后台线程中解析中文字体，页面首屏无需等待 Matplotlib 加载或字体下载。
+    解析顺序：持久化的字体路径缓存 -> 系统字体 -> 本地 SimHei.ttf -> 流式下载 (有超时和总时限)。
+    结果路径写入 font_path.json，下次启动直接使用；下载失败也会记录，离线时退回默认字体。
+    """
+
+    def __init__(self, cache_dir=FONT_CACHE_DIR, url=FONT_DOWNLOAD_URL):
+        self.cache_dir = cache_dir
+        self.url = url
+        self.font_prop = None
+        self.source = None
+        self.error = None
+        self._done = threading.Event()
+        threading.Thread(target=self._run, name="font-bootstrap", daemon=True).start()
+
+    @property
+    def _cache_file(self):
+        return os.path.join(self.cache_dir, "font_path.json")
+
+    def _read_cache(self):
+        try:
+            with open(self._cache_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_cache(self, record):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._cache_file, "w", encoding="utf-8") as f:
+                json.dump(record, f)
+        except OSError:
+            pass
+
+    def _find_path(self):
+        cached = self._read_cache()
+        if cached.get("path") and os.path.exists(cached["path"]):
+            return cached["path"], "cache"
+
+        import matplotlib.font_manager as fm
+        system_fonts = {f.name: f.fname for f in fm.fontManager.ttflist}
+        for font in COMMON_CN_FONTS:
+            if font in system_fonts:
+                return system_fonts[font], "system"
+
+        local_path = os.path.join(self.cache_dir, "SimHei.ttf")
+        for path in (local_path, "SimHei.ttf"):  # 兼容旧版本下载到工作目录的字体
+            if os.path.exists(path):
+                return os.path.abspath(path), "local"
+
+        if time.time() - cached.get("failed_at", 0) < FONT_RETRY_AFTER:
+            raise RuntimeError(f"字体最近一次下载失败 ({cached.get('error')})，暂不重试")
+        self._download(local_path)
+        return local_path, "download"
+
+    def _download(self, path):
+        import requests
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = path + ".part"
+        deadline = time.monotonic() + FONT_DOWNLOAD_DEADLINE
+        try:
+            with requests.get(self.url, stream=True, timeout=FONT_DOWNLOAD_TIMEOUT) as resp:
+                resp.raise_for_status()
+                with open(tmp_path, "wb") as f:
+                    for chunk in resp.iter_content(chunk_size=256 * 1024):
+                        if time.monotonic() > deadline:
+                            raise TimeoutError(f"字体下载超过 {FONT_DOWNLOAD_DEADLINE} 秒")
+                        f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _run(self):
+        try:
+            path, self.source = self._find_path()
+            import matplotlib
+            import matplotlib.font_manager as fm
+            fm.fontManager.addfont(path)
+            self.font_prop = fm.FontProperties(fname=path)
+            # 设置 Matplotlib 全局字体
+            matplotlib.rcParams['font.sans-serif'] = [self.font_prop.get_name()] + list(
+                matplotlib.rcParams['font.sans-serif'])
+            matplotlib.rcParams['axes.unicode_minus'] = False
+            if self.source != "cache":
+                self._write_cache({"path": path})
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            if not isinstance(e, RuntimeError):
+                self._write_cache({"failed_at": time.time(), "error": self.error})
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """等待字体解析完成 (最长为下载总时限)，返回 FontProperties；不可用时返回 None。"""
+        self._done.wait(timeout)
+        return self.font_prop
+
+
+@st.cache_resource
+def get_font_bootstrap():
+    """进程级共享的字体解析任务；首次调用时在后台启动。"""
+    return FontBootstrap()
+
 
-    return fm.FontProperties(fname=font_path)
+def chinese_font():
+    """绘图时取中文字体 (必要时等待后台解析完成)。"""
+    return get_font_bootstrap().wait(FONT_DOWNLOAD_DEADLINE + sum(FONT_DOWNLOAD_TIMEOUT))
 
 
-# 获取字体属性
-font_prop = get_chinese_font()
-# 设置 Matplotlib 全局字体 (如果找到了字体)
-if font_prop:
-    plt.rcParams['font.sans-serif'] = [font_prop.get_name()]
-    plt.rcParams['axes.unicode_minus'] = False
+# --- 柱状图 / 折线图预聚合 (绘图只处理每组一行的汇总表) ---
+ERROR_BAR_TYPES = ('sd', 'se', 'ci')
+BOOTSTRAP_RESAMPLES = 1000  # 与 seaborn 默认的 n_boot 一致
+BOOTSTRAP_CI = 95
+BOOTSTRAP_EXACT_MAX = 20_000  # 超过该样本量的组，均值的自助分布已近似正态，改用 mean ± z·se
+BOOTSTRAP_BLOCK = 4_000_000  # 每批重抽样的元素数上限，控制内存
+
+
+def bootstrap_mean_ci(values, codes, n_groups, n_boot=BOOTSTRAP_RESAMPLES, ci=BOOTSTRAP_CI, seed=0,
+                      exact_max=BOOTSTRAP_EXACT_MAX):
+    """
+    各组均值的百分位自助法置信区间，所有组在同一批矩阵运算中一起重抽样。
+    values 与 codes (组号，-1 表示不参与) 逐行对应，返回 (low, high) 两个长度为 n_groups 的数组。
+    """
+    from statistics import NormalDist
+    values = np.asarray(values, dtype=float)
+    codes = np.asarray(codes)
+    valid = (codes >= 0) & ~np.isnan(values)
+    order = np.argsort(codes[valid], kind='stable')
+    values, codes = values[valid][order], codes[valid][order].astype(np.int64)
+    sizes = np.bincount(codes, minlength=n_groups)
+    low, high = np.full(n_groups, np.nan), np.full(n_groups, np.nan)
+
+    large = sizes > exact_max
+    if large.any():
+        sums = np.bincount(codes, weights=values, minlength=n_groups)
+        sq = np.bincount(codes, weights=values * values, minlength=n_groups)
+        n = np.maximum(sizes, 1)
+        mean = sums / n
+        se = np.sqrt(np.maximum(sq / n - mean * mean, 0) / np.maximum(n - 1, 1))
+        z = NormalDist().inv_cdf(0.5 + ci / 200)
+        low[large], high[large] = (mean - z * se)[large], (mean + z * se)[large]
+
+    small = np.flatnonzero((sizes > 0) & ~large)
+    if len(small):
+        remap = np.full(n_groups, -1)
+        remap[small] = np.arange(len(small))
+        keep = remap[codes] >= 0
+        vals, sub_codes = values[keep], remap[codes[keep]]
+        sub_sizes = sizes[small]
+        starts = np.concatenate([[0], np.cumsum(sub_sizes)[:-1]])
+        row_start, row_size = starts[sub_codes], sub_sizes[sub_codes]
+        rng = np.random.default_rng(seed)
+        means = np.empty((n_boot, len(small)))
+        block = max(1, BOOTSTRAP_BLOCK // len(vals))
+        for b0 in range(0, n_boot, block):
+            b = min(block, n_boot - b0)
+            # 每组在自身的行区间内有放回抽样，再按组分段求和
+            idx = row_start + (rng.random((b, len(vals))) * row_size).astype(np.int64)
+            means[b0:b0 + b] = np.add.reduceat(vals[idx], starts, axis=1) / sub_sizes
+        low[small], high[small] = np.percentile(means, [50 - ci / 2, 50 + ci / 2], axis=0)
+    return low, high
+
+
+@perf_timed("aggregate.groups")
+def summarize_groups(df, x, y, hue=None, error_bar='sd', n_boot=BOOTSTRAP_RESAMPLES, ci=BOOTSTRAP_CI, seed=0):
+    """
+    按 (x, 分组) 一次 groupby 得到 count / mean / sd / se，error_bar='ci' 时附加 ci_low / ci_high。
+    组的顺序与 seaborn 一致：分类列按类别顺序，其余按首次出现顺序 (数值 x 由 seaborn 自行排序)。
+    """
+    keys = list(dict.fromkeys(k for k in (x, hue) if k is not None))
+    grouped = df[y].astype(float).groupby([df[k] for k in keys], observed=True, sort=False)
+    stats = grouped.agg(['count', 'mean', 'std'])
+    summary = stats.index.to_frame(index=False)
+    summary['count'] = stats['count'].to_numpy()
+    summary['mean'] = stats['mean'].to_numpy()
+    summary['sd'] = stats['std'].to_numpy()
+    summary['se'] = summary['sd'] / np.sqrt(summary['count'])
+    if error_bar == 'ci':
+        codes = grouped.ngroup().to_numpy(dtype=float, na_value=-1).astype(np.int64)
+        summary['ci_low'], summary['ci_high'] = bootstrap_mean_ci(df[y], codes, len(summary), n_boot, ci, seed)
+    return summary[summary['count'] > 0].reset_index(drop=True)
+
+
+@st.cache_resource(max_entries=32)
+def get_chart_summary(data_key, x, y, hue, error_bar, _df):
+    """按数据键缓存的分组汇总表；同一数据换标题、换图表类型时不再重新扫描原始数据。"""
+    return summarize_groups(_df, x, y, hue, error_bar)
+
+
+def interval_frame(summary, x, y, hue=None, error_bar='sd'):
+    """
+    把汇总表展开为每组三行 (下界、均值、上界)，交给 seaborn 以 estimator='median'、errorbar=('pi', 100) 绘制：
+    中位数即均值，最小-最大区间即误差线，图形与直接传原始数据完全一致，而数据量只与组数有关。
+    """
+    keys = list(dict.fromkeys(k for k in (x, hue) if k is not None))
+    mean = summary['mean']
+    if error_bar == 'ci':
+        low, high = summary['ci_low'], summary['ci_high']
+    elif error_bar in ('sd', 'se'):
+        low, high = mean - summary[error_bar], mean + summary[error_bar]
+    else:
+        low = high = mean
+    # 单个观测的组没有标准差，误差线退化为一点
+    frames = []
+    for bound in (low.fillna(mean), mean, high.fillna(mean)):
+        frame = summary[keys].copy()
+        frame[y] = bound.to_numpy()
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+# --- 生存分析 (Kaplan-Meier / Greenwood / Log-rank，全部向量化) ---
+SURVIVAL_CI = 95
+SURVIVAL_RISK_TICKS = 6  # 风险人数表的时间点个数
+CENSOR_MARK_MAX = 500  # 删失人数多于此数时不再逐个标记
+SURVIVAL_TIME_NAMES = ('time', '时间', 'os', 'survival_time', 'months', 'days')
+SURVIVAL_EVENT_NAMES = ('event', 'status', '事件', '状态', 'dead', 'death', 'censor')
+SURVIVAL_GROUP_NAMES = ('group', '分组', 'arm', 'treatment')
+
+
+def guess_column(cols, candidates, default):
+    """按列名 (不区分大小写) 猜测列的位置，找不到时返回 default。"""
+    names = [str(c).strip().lower() for c in cols]
+    for candidate in candidates:
+        if candidate in names:
+            return names.index(candidate)
+    return default
+
+
+def chi2_sf(x, dof):
+    """卡方分布的右尾概率 (整数自由度，闭式级数，无需 scipy)。"""
+    import math
+    if x <= 0:
+        return 1.0
+    half = x / 2
+    if dof % 2 == 0:
+        term, total = 1.0, 1.0
+        for i in range(1, dof // 2):
+            term *= half / i
+            total += term
+        return min(1.0, math.exp(-half) * total)
+    term, total = math.sqrt(half) / math.gamma(1.5), 0.0
+    for i in range(1, (dof + 1) // 2):
+        total += term
+        term *= half / (i + 0.5)
+    return min(1.0, math.erfc(math.sqrt(half)) + math.exp(-half) * total)
+
+
+def _survival_arrays(df, time_col, event_col, group_col=None):
+    """取出 (时间, 事件, 组号, 组名)：去掉缺失时间，事件按 >0 视为发生，按时间排序一次 (后续各步不再排序)。"""
+    time = pd.to_numeric(df[time_col], errors='coerce').to_numpy(dtype=float)
+    event = pd.to_numeric(df[event_col], errors='coerce').to_numpy(dtype=float)
+    valid = ~np.isnan(time) & ~np.isnan(event)
+    if group_col is not None:
+        valid &= df[group_col].notna().to_numpy()
+    if not valid.any():
+        raise ValueError(f"时间列 {time_col} 与事件列 {event_col} 中没有可用的数值数据")
+    if group_col is not None:
+        # 只对有效行编码，保证每个组至少有一条记录
+        codes, labels = pd.factorize(df[group_col][valid], sort=True)
+        labels = [str(v) for v in labels]
+    else:
+        codes, labels = np.zeros(int(valid.sum()), dtype=np.int64), ['全部']
+    time, event = time[valid], event[valid] > 0
+    order = np.argsort(time)
+    return time[order], event[order], codes[order], labels
+
+
+def _run_starts(sorted_values):
+    """有序数组中每段相同取值的起始下标。"""
+    return np.flatnonzero(np.diff(sorted_values, prepend=np.nan) != 0)
+
+
+def kaplan_meier(time, event, ci=SURVIVAL_CI):
+    """
+    已按时间升序排列的一组数据的 Kaplan-Meier 估计。
+    每个不同时间点一行：at_risk / events / censored / survival，以及 Greenwood 方差经 log(-log) 变换的置信区间。
+    """
+    from statistics import NormalDist
+    start = _run_starts(time)
+    times, counts = time[start], np.diff(np.append(start, len(time)))
+    events = np.add.reduceat(event.astype(np.int64), start) if len(time) else np.zeros(0, dtype=np.int64)
+    at_risk = len(time) - np.concatenate([[0], np.cumsum(counts)[:-1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        survival = np.cumprod(1 - events / at_risk)
+        greenwood = np.cumsum(np.where(at_risk > events, events / (at_risk * (at_risk - events)), np.inf))
+        log_s = np.log(survival)
+        z = NormalDist().inv_cdf(0.5 + ci / 200)
+        spread = z * np.sqrt(greenwood) / np.abs(log_s)
+        ci_low = survival ** np.exp(spread)
+        ci_high = survival ** np.exp(-spread)
+    # S=1 时区间退化为 1；方差不可估计 (最后一人发生事件) 时区间为空
+    ci_low = np.where(survival >= 1, 1.0, ci_low)
+    ci_high = np.where(survival >= 1, 1.0, ci_high)
+    return pd.DataFrame({'time': times, 'at_risk': at_risk, 'events': events, 'censored': counts - events,
+                         'survival': survival, 'ci_low': ci_low, 'ci_high': ci_high})
+
+
+def logrank_test(time, event, codes, n_groups):
+    """多组 log-rank 检验 (time 已升序)，返回 (卡方值, 自由度, p 值)。"""
+    inverse = np.cumsum(np.diff(time, prepend=np.nan) != 0) - 1 if len(time) else time.astype(np.int64)
+    n_times = int(inverse[-1]) + 1 if len(time) else 0
+    flat = inverse * n_groups + codes
+    total = np.bincount(flat, minlength=n_times * n_groups).reshape(n_times, n_groups)
+    deaths = np.bincount(flat, weights=event, minlength=n_times * n_groups).reshape(n_times, n_groups)
+    # 各时间点各组的风险人数 = 该时间及之后的人数 (逆序累加)
+    risk = np.cumsum(total[::-1], axis=0)[::-1]
+    n, d = risk.sum(axis=1), deaths.sum(axis=1)
+    keep = (d > 0) & (n > 1)
+    risk, deaths, n, d = risk[keep], deaths[keep], n[keep], d[keep]
+    share = risk / n[:, None]
+    observed, expected = deaths.sum(axis=0), (share * d[:, None]).sum(axis=0)
+    weight = d * (n - d) / (n - 1)
+    weighted = share * weight[:, None]
+    var = np.diag(weighted.sum(axis=0)) - weighted.T @ share
+    diff = (observed - expected)[:-1]
+    dof = n_groups - 1
+    chi2 = float(diff @ np.linalg.pinv(var[:-1, :-1]) @ diff)
+    return chi2, dof, chi2_sf(chi2, dof)
+
+
+@perf_timed("aggregate.survival")
+def survival_analysis(df, time_col, event_col, group_col=None, ci=SURVIVAL_CI):
+    """各组 Kaplan-Meier 曲线表 + 组间 log-rank 检验 (单组时为 None)。"""
+    time, event, codes, labels = _survival_arrays(df, time_col, event_col, group_col)
+    curves = {}
+    for i, label in enumerate(labels):
+        mask = codes == i if len(labels) > 1 else slice(None)
+        curves[label] = kaplan_meier(time[mask], event[mask], ci)
+    logrank = logrank_test(time, event, codes, len(labels)) if len(labels) > 1 else None
+    return {'curves': curves, 'logrank': logrank}
+
+
+@st.cache_resource(max_entries=16)
+def get_survival_analysis(data_key, time_col, event_col, group_col, _df):
+    """按数据键缓存的生存分析结果。"""
+    return survival_analysis(_df, time_col, event_col, group_col)
+
+
+def at_risk_counts(curve, ticks):
+    """各时间点 t 的风险人数 (时间 ≥ t 的人数)，由曲线表直接查得。"""
+    idx = np.searchsorted(curve['time'].to_numpy(), ticks, side='left')
+    at_risk = np.append(curve['at_risk'].to_numpy(), 0)
+    return at_risk[idx]
+
+
+def draw_survival(ax, result, show_ci=True, show_censors=True, risk_table=True, font_prop=None):
+    """绘制阶梯生存曲线、置信带、删失标记、风险人数表与 log-rank p 值。"""
+    from matplotlib.transforms import blended_transform_factory
+    import seaborn as sns
+    curves = result['curves']
+    colors = sns.color_palette("deep", len(curves))
+    for (label, curve), color in zip(curves.items(), colors):
+        # 曲线从 (0, 1) 开始
+        t = np.concatenate([[0.0], curve['time'].to_numpy()])
+        s = np.concatenate([[1.0], curve['survival'].to_numpy()])
+        n = int(curve['at_risk'].iat[0]) if len(curve) else 0
+        ax.step(t, s, where='post', color=color, label=f"{label} (n={n:,})")
+        if show_ci:
+            low = np.concatenate([[1.0], curve['ci_low'].to_numpy()])
+            high = np.concatenate([[1.0], curve['ci_high'].to_numpy()])
+            ax.fill_between(t, low, high, step='post', color=color, alpha=0.2, linewidth=0)
+        censored = curve['censored'].to_numpy() > 0
+        if show_censors and 0 < curve['censored'].sum() <= CENSOR_MARK_MAX:
+            ax.plot(curve['time'].to_numpy()[censored], curve['survival'].to_numpy()[censored],
+                    '|', color=color, markersize=8)
+    ax.set_ylim(0, 1.05)
+    ax.set_xlim(left=0)
+    ax.legend(prop=font_prop, frameon=False, loc='lower left')
+
+    if result['logrank'] is not None:
+        chi2, dof, p = result['logrank']
+        p_text = "p < 0.001" if p < 0.001 else f"p = {p:.3f}"
+        ax.text(0.98, 0.98, f"Log-rank χ²({dof}) = {chi2:.2f}, {p_text}", transform=ax.transAxes,
+                ha='right', va='top', fontsize=10)
+
+    if risk_table:
+        ticks = [t for t in ax.get_xticks() if ax.get_xlim()[0] <= t <= ax.get_xlim()[1]][:SURVIVAL_RISK_TICKS * 2]
+        transform = blended_transform_factory(ax.transData, ax.transAxes)
+        # 行标题向左偏移，避开 t=0 处居中的人数
+        row_title = dict(xycoords='axes fraction', xytext=(-30, 0), textcoords='offset points', ha='right', va='top',
+                         fontsize=9, fontproperties=font_prop)
+        ax.annotate("风险人数", (0, -0.16), fontweight='bold', **row_title)
+        for row, ((label, curve), color) in enumerate(zip(curves.items(), colors)):
+            y = -0.16 - 0.06 * (row + 1)
+            ax.annotate(label, (0, y), color=color, **row_title)
+            for tick, count in zip(ticks, at_risk_counts(curve, ticks)):
+                ax.text(tick, y, f"{count:,}", transform=transform, ha='center', va='top', fontsize=9)
+
+
+# --- 大矩阵热图 (像素网格降采样 / 层次聚类排序 / 栅格化输出) ---
+HEATMAP_CHUNK_ELEMENTS = 4_000_000  # 流式降采样时每块读取的元素数上限
+HEATMAP_MAX_TICK_LABELS = 60  # 行/列数不超过此值且未被聚合时才标注名称
+HEATMAP_CLUSTER_METRICS = ('euclidean', 'correlation')
+CLUSTER_EXACT_MAX = 1000  # 不超过此数时直接做平均连接层次聚类，否则先 k-means 分为这么多簇
+CLUSTER_MAX_FEATURES = 128  # 聚类前把另一维按块平均压缩到此宽度
+CLUSTER_KMEANS_ITERS = 8
+
+
+def heatmap_columns(df):
+    """热图使用的列：(数值列, 文本列)；首个文本列作为行名。"""
+    numeric = [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])]
+    if not numeric:
+        raise ValueError("热图需要至少一个数值列")
+    return numeric, [c for c in df.columns if c not in numeric]
+
+
+def heatmap_matrix(df):
+    """
+    取数值列组成矩阵。单一数据块 (如内存映射的 .npy) 不复制；按列存储的表 (CSV / XLSX 分块读入)
+    会复制整个矩阵，因此只在降采样网格缓存未命中时调用。
+    """
+    numeric, _ = heatmap_columns(df)
+    matrix = (df if len(numeric) == len(df.columns) else df[numeric]).to_numpy()
+    return matrix.reshape(-1, 1) if matrix.ndim == 1 else matrix
+
+
+def heatmap_row_labels(df):
+    """行名：首个文本列，没有时用索引。"""
+    _, text = heatmap_columns(df)
+    return df[text[0]].astype(str).to_numpy() if text else df.index.astype(str).to_numpy()
+
+
+def _bin_edges(n, bins):
+    return np.linspace(0, n, bins + 1).round().astype(np.int64)
+
+
+def downsample_matrix(matrix, out_rows, out_cols, row_order=None, col_order=None):
+    """
+    把 (可能是内存映射的) 矩阵按块平均聚合到 out_rows × out_cols 的网格，缺失值不计入均值。
+    按行分块流式读取，峰值内存与矩阵大小无关；row_order / col_order 为聚类后的行列顺序。
+    """
+    n, m = matrix.shape
+    out_rows, out_cols = max(1, min(out_rows, n)), max(1, min(out_cols, m))
+    row_bins = np.repeat(np.arange(out_rows), np.diff(_bin_edges(n, out_rows)))
+    col_starts = _bin_edges(m, out_cols)[:-1]
+    sums, counts = np.zeros((out_rows, out_cols)), np.zeros((out_rows, out_cols))
+    step = max(1, HEATMAP_CHUNK_ELEMENTS // max(m, 1))
+    for start in range(0, n, step):
+        stop = min(start + step, n)
+        rows = row_order[start:stop] if row_order is not None else slice(start, stop)
+        block = np.asarray(matrix[rows], dtype=float)
+        if col_order is not None:
+            block = block[:, col_order]
+        finite = np.isfinite(block)
+        block = np.where(finite, block, 0.0)
+        bins = row_bins[start:stop]
+        starts = _run_starts(bins)
+        sums[bins[starts]] += np.add.reduceat(np.add.reduceat(block, col_starts, axis=1), starts, axis=0)
+        counts[bins[starts]] += np.add.reduceat(np.add.reduceat(finite, col_starts, axis=1, dtype=float),
+                                                starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def _cluster_features(matrix, axis, metric):
+    """聚类用的特征：另一维按块平均压缩后的行 (axis=0) 或列 (axis=1)；correlation 时标准化为单位向量。"""
+    n, m = matrix.shape
+    if axis == 0:
+        features = downsample_matrix(matrix, n, CLUSTER_MAX_FEATURES)
+    else:
+        features = downsample_matrix(matrix, CLUSTER_MAX_FEATURES, m).T
+    features = np.nan_to_num(features)
+    if metric == 'correlation':
+        features = features - features.mean(axis=1, keepdims=True)
+        norm = np.linalg.norm(features, axis=1, keepdims=True)
+        features = np.divide(features, norm, out=np.zeros_like(features), where=norm > 0)
+    return features
+
+
+def average_linkage_order(features, metric='euclidean'):
+    """
+    平均连接层次聚类 (最近邻链算法，O(n²))，返回树状图的叶序。
+    metric='correlation' 时 features 应已标准化为单位向量，距离为 1 - r。
+    """
+    n = len(features)
+    if n <= 2:
+        return np.arange(n)
+    features = np.asarray(features, dtype=float)
+    gram = features @ features.T
+    if metric == 'correlation':
+        dist = 1.0 - gram
+    else:
+        sq = np.diag(gram)
+        dist = np.sqrt(np.maximum(sq[:, None] + sq[None, :] - 2 * gram, 0))
+    np.fill_diagonal(dist, np.inf)
+    size = np.ones(n)
+    node = np.arange(n)
+    active = np.ones(n, dtype=bool)
+    children = []
+    chain = []
+    for _ in range(n - 1):
+        while True:
+            if not chain:
+                chain.append(int(np.argmax(active)))
+            a = chain[-1]
+            b = int(np.argmin(dist[a]))
+            if len(chain) > 1 and dist[a, chain[-2]] <= dist[a, b]:
+                b = chain[-2]
+            if len(chain) > 1 and b == chain[-2]:
+                break
+            chain.append(b)
+        chain.pop()
+        chain.pop()
+        # b 并入 a (Lance-Williams 平均连接更新)，b 的行列置为无穷
+        merged = (size[a] * dist[a] + size[b] * dist[b]) / (size[a] + size[b])
+        dist[a, :] = merged
+        dist[:, a] = merged
+        dist[b, :] = np.inf
+        dist[:, b] = np.inf
+        dist[a, a] = np.inf
+        active[b] = False
+        size[a] += size[b]
+        children.append((node[a], node[b]))
+        node[a] = n + len(children) - 1
+    order, stack = [], [2 * n - 2]
+    while stack:
+        c = stack.pop()
+        if c < n:
+            order.append(c)
+        else:
+            left, right = children[c - n]
+            stack.extend((right, left))
+    return np.array(order)
+
+
+def kmeans(features, k, iters=CLUSTER_KMEANS_ITERS, seed=0):
+    """Lloyd k-means (分块计算距离)，返回 (标签, 簇中心)；空簇保留原中心。"""
+    rng = np.random.default_rng(seed)
+    features = np.asarray(features, dtype=np.float32)  # 单精度矩阵乘法快一倍，排序用途精度足够
+    centers = features[rng.choice(len(features), k, replace=False)].copy()
+    step = max(1, HEATMAP_CHUNK_ELEMENTS // k)
+    for _ in range(iters):
+        c_sq = (centers * centers).sum(axis=1)
+        labels = np.concatenate([np.argmin(c_sq[None, :] - 2 * features[i:i + step] @ centers.T, axis=1)
+                                 for i in range(0, len(features), step)])
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, features)
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled, None]
+    return labels, centers
+
+
+def cluster_order(features, metric='euclidean', exact_max=CLUSTER_EXACT_MAX):
+    """
+    层次聚类排序。超过 exact_max 时先用 k-means 分成 exact_max 个簇，对簇中心做层次聚类，
+    再按簇中心的叶序排列各簇成员 (簇内保持原顺序)；几万行时仍只需 O(exact_max²) 内存。
+    """
+    n = len(features)
+    if n <= exact_max:
+        return average_linkage_order(features, metric)
+    labels, centers = kmeans(features, exact_max)
+    if metric == 'correlation':
+        norm = np.linalg.norm(centers, axis=1, keepdims=True)
+        centers = np.divide(centers, norm, out=np.zeros_like(centers), where=norm > 0)
+    used = np.flatnonzero(np.bincount(labels, minlength=exact_max))
+    rank = np.empty(exact_max, dtype=np.int64)
+    rank[used[average_linkage_order(centers[used], metric)]] = np.arange(len(used))
+    return np.argsort(rank[labels], kind='stable')
+
+
+@st.cache_resource(max_entries=16)
+def get_cluster_order(data_key, axis, metric, _matrix):
+    """按数据键缓存的聚类叶序 (axis=0 为行，1 为列)。"""
+    return cluster_order(_cluster_features(_matrix, axis, metric), metric)
+
+
+@st.cache_resource(max_entries=8)
+def get_heatmap_grid(data_key, shape, cluster_rows, cluster_cols, metric, _df):
+    """按数据键缓存的降采样网格；预览与导出共用同一网格。矩阵只在未命中时才由 _df 构建。"""
+    return heatmap_grid(heatmap_matrix(_df), shape, cluster_rows, cluster_cols, metric, data_key)
+
+
+@perf_timed("aggregate.heatmap")
+def heatmap_grid(matrix, shape, cluster_rows=False, cluster_cols=False, metric='euclidean', data_key=None):
+    """返回 (网格, 行序, 列序)。给出 data_key 时聚类结果走缓存。"""
+    def order(axis):
+        if data_key is not None:
+            return get_cluster_order(data_key, axis, metric, matrix)
+        return cluster_order(_cluster_features(matrix, axis, metric), metric)
+    row_order = order(0) if cluster_rows and matrix.shape[0] > 2 else None
+    col_order = order(1) if cluster_cols and matrix.shape[1] > 2 else None
+    return downsample_matrix(matrix, shape[0], shape[1], row_order, col_order), row_order, col_order
+
+
+def draw_heatmap(fig, ax, df, cluster_rows=False, cluster_cols=False, metric='euclidean', data_key=None,
+                 dpi=EXPORT_DPI, font_prop=None):
+    """
+    大矩阵热图：先聚合到导出分辨率下坐标区的像素网格，再作为一张栅格图像绘制，
+    SVG / PDF 中同样只嵌入一张位图，文件大小与耗时不随矩阵规模增长。
+    """
+    from matplotlib.colors import Normalize
+    numeric, _ = heatmap_columns(df)
+    n_rows, n_cols = len(df), len(numeric)
+    bbox = ax.get_position()
+    width, height = fig.get_size_inches()
+    shape = (int(bbox.height * height * dpi), int(bbox.width * width * dpi))
+    if data_key is not None:
+        grid, row_order, col_order = get_heatmap_grid(data_key, shape, cluster_rows, cluster_cols, metric, df)
+    else:
+        grid, row_order, col_order = heatmap_grid(heatmap_matrix(df), shape, cluster_rows, cluster_cols, metric)
+
+    finite = grid[np.isfinite(grid)]
+    if finite.size and finite.min() < 0 < finite.max():
+        # 有正有负 (如相关系数、log 倍数变化) 时用以 0 为中心的发散色带
+        vmax = float(np.percentile(np.abs(finite), 99)) or 1.0
+        cmap, norm = 'RdBu_r', Normalize(-vmax, vmax)
+    else:
+        low, high = np.percentile(finite, [1, 99]) if finite.size else (0.0, 1.0)
+        cmap, norm = 'viridis', Normalize(low, high if high > low else low + 1)
+    image = ax.imshow(grid, aspect='auto', interpolation='nearest', cmap=cmap, norm=norm, rasterized=True)
+    cbar = fig.colorbar(image, ax=ax, fraction=0.04, pad=0.02)
+    cbar.solids.set_rasterized(True)
+
+    # 行名只在会逐行标注时才生成 (大矩阵不为几百万行做字符串转换)
+    for axis, n, order, size in ((0, n_rows, row_order, grid.shape[0]), (1, n_cols, col_order, grid.shape[1])):
+        set_ticks, set_labels = ((ax.set_yticks, ax.set_yticklabels) if axis == 0
+                                 else (ax.set_xticks, ax.set_xticklabels))
+        if size == n and size <= HEATMAP_MAX_TICK_LABELS:
+            labels = heatmap_row_labels(df) if axis == 0 else np.array([str(c) for c in numeric], dtype=object)
+            set_ticks(np.arange(size))
+            set_labels(labels if order is None else labels[order], fontproperties=font_prop,
+                       rotation=0 if axis == 0 else 90, fontsize=8)
+        else:
+            set_ticks([])
+    ax.text(1.0, 1.01, f"{n_rows:,} × {n_cols:,}", transform=ax.transAxes,
+            ha='right', va='bottom', fontsize=8, color='#666')
+
+
+# --- 图表绘制函数 (与界面解耦，供页面与批量渲染共用) ---
+# 批量渲染规格中的图表简称 -> 界面中的图表类型
+CHART_TYPES = {
+    'bar': '柱状图 (Bar Plot)',
+    'line': '折线图 (Line Plot)',
+    'scatter': '散点图 (Scatter Plot)',
+    'survival': '生存曲线 (Survival Plot)',
+    'heatmap': '热图 (Heatmap)',
+    'gis': 'GIS地图 (Map Viz)',
+}
+
+
+def render_chart(fig, ax, df, chart_type, x, y, hue=None, error_bar='sd', point_mode='自动',
+                 title='', x_label='', y_label='', data_key=None, cluster_rows=False, cluster_cols=False,
+                 cluster_metric='euclidean'):
+    """
+    绘制常规学术图表 (柱状图 / 折线图 / 散点图 / 生存曲线 / 热图)。chart_type 可以是界面名称或 CHART_TYPES 中的简称。
+    error_bar 为 sd / se / ci (自助法 95% 置信区间) 或 None；给出 data_key (数据内容的哈希) 时分组汇总表按其缓存。
+    热图使用全部数值列，cluster_* 控制行/列层次聚类排序。
+    """
+    import seaborn as sns
+    chart_type = CHART_TYPES.get(chart_type, chart_type)
+    font_prop = chinese_font()
+    sns.set_style("ticks")
+    sns.set_context("paper", font_scale=1.2)
+
+    if chart_type in ('柱状图 (Bar Plot)', '折线图 (Line Plot)') and y not in (x, hue) \
+            and pd.api.types.is_numeric_dtype(df[y]):
+        # 先聚合为每组一行，绘图耗时与原始行数无关
+        summary = (get_chart_summary(data_key, x, y, hue, error_bar, df) if data_key
+                   else summarize_groups(df, x, y, hue, error_bar))
+        df = interval_frame(summary, x, y, hue, error_bar)
+        estimator, error_bar = 'median', (('pi', 100) if error_bar in ERROR_BAR_TYPES else None)
+    else:
+        estimator = 'mean'
+
+    if chart_type == '柱状图 (Bar Plot)':
+        sns.barplot(data=df, x=x, y=y, hue=hue, estimator=estimator,
+                    capsize=.1, errorbar=error_bar, ax=ax, palette="viridis")
+    elif chart_type == '折线图 (Line Plot)':
+        sns.lineplot(data=df, x=x, y=y, hue=hue, marker='o', estimator=estimator, errorbar=error_bar, ax=ax)
+    elif chart_type == '散点图 (Scatter Plot)':
+        if use_point_aggregation(point_mode, len(df)):
+            image = draw_point_density(ax, df[x], df[y], cmap='viridis')
+            cbar = fig.colorbar(image, ax=ax, fraction=0.04, pad=0.02)
+            cbar.set_label("点数 (Count)", fontproperties=font_prop)
+        else:
+            sns.scatterplot(data=df, x=x, y=y, hue=hue, ax=ax)
+    elif chart_type == '生存曲线 (Survival Plot)':
+        # x 为时间列，y 为事件列，hue 为分组列
+        result = (get_survival_analysis(data_key, x, y, hue, df) if data_key
+                  else survival_analysis(df, x, y, hue))
+        draw_survival(ax, result, font_prop=font_prop)
+    elif chart_type == '热图 (Heatmap)':
+        draw_heatmap(fig, ax, df, cluster_rows, cluster_cols, cluster_metric, data_key, font_prop=font_prop)
+
+    # 确保常规图表也使用中文字体
+    ax.set_title(title, fontproperties=font_prop)
+    ax.set_xlabel(x_label, fontproperties=font_prop)
+    ax.set_ylabel(y_label, fontproperties=font_prop)
+
+    # 设置坐标轴刻度字体
+    for label in ax.get_xticklabels() + ax.get_yticklabels():
+        label.set_fontproperties(font_prop)
+
+    sns.despine(ax=ax)
+
+
+def render_gis_map(fig, ax, geojson, cache_key, density_map, points_df=None, lon_col='经度', lat_col='纬度',
+                   name_col=None, title='', cmap_name='Blues', density_label='企业数量密度', show_labels=True,
+                   simplify=True, show_points=True, point_mode='自动', show_point_labels=False, label_budget=50):
+    """绘制行政区划密度图：区域着色 + 区域名称 + 点位 (散点或密度栅格) + 指北针。"""
+    import matplotlib
+    from matplotlib.cm import ScalarMappable
+    from matplotlib.colors import Normalize
+    font_prop = chinese_font()
+    # 确保标题使用中文字体
+    ax.set_title(title, fontsize=18, pad=20, fontproperties=font_prop)
+
+    geojson_data = geojson
+    if simplify:
+        geojson_data = simplify_for_figure(cache_key, geojson, figsize=tuple(fig.get_size_inches()), dpi=EXPORT_DPI)
+    features = geojson_data.get('features', [])
+
+    max_val = (max(density_map.values()) if density_map else 1) or 1
+    cmap = matplotlib.colormaps[cmap_name]
+
+    # 1. 绘制行政区划 (密度背景)：所有区域合并为一个集合对象
+    values = [density_map.get(f['properties'].get('name'), 0) for f in features]
+    region_collection = build_region_collection(features, values, cmap, max_val)
+    ax.add_collection(region_collection)
+
+    if show_labels:
+        # 标注锚点取自要素几何表 (不可达极点)，保证落在凹多边形内部
+        feature_table = get_feature_table(cache_key, geojson)
+        for name, lx, ly in zip(feature_table['name'], feature_table['label_x'], feature_table['label_y']):
+            if np.isnan(lx) or np.isnan(ly): continue
+            ax.text(lx, ly, name, ha='center', va='center',
+                    fontsize=9, color='#333', fontweight='bold', fontproperties=font_prop)
+
+    # 2. 绘制具体点位 (前景)
+    if show_points and points_df is not None:
+        if use_point_aggregation(point_mode, len(points_df)):
+            draw_point_density(ax, points_df[lon_col], points_df[lat_col], equal_bins=True, zorder=10, alpha=0.9)
+        else:
+            ax.scatter(points_df[lon_col], points_df[lat_col], c='#FF9800', s=30, marker='^',
+                       edgecolors='white', linewidth=0.5, label='物流站点', zorder=10)
+
+    sm = ScalarMappable(cmap=cmap, norm=Normalize(vmin=0, vmax=max_val))
+    sm.set_array([])
+    cbar = fig.colorbar(sm, ax=ax, fraction=0.03, pad=0.04)
+    cbar.set_label(density_label, fontsize=10, fontproperties=font_prop)
+
+    # 指北针
+    ax.text(0.95, 0.95, 'N', transform=ax.transAxes, ha='center', fontsize=16, fontweight='bold')
+    ax.arrow(0.95, 0.90, 0, 0.08, transform=ax.transAxes, head_width=0.02, head_length=0.03, fc='k', ec='k')
+
+    ax.autoscale()
+    ax.set_aspect('equal')
+    ax.axis('off')
+
+    # 仅当勾选时才显示点位名称 (需在坐标范围确定后放置，以便做碰撞检测)
+    if show_points and show_point_labels and points_df is not None and name_col:
+        place_point_labels(ax, points_df[lon_col], points_df[lat_col], points_df[name_col],
+                           budget=label_budget, color='#d35400', fontproperties=font_prop)
+
+
+# --- 数据导入 (大文件) ---
+INGEST_CHUNK_ROWS = 250_000
+CATEGORY_MAX_RATIO = 0.5  # 文本列唯一值占比低于该值时转为 category
+UPLOAD_TYPES = ["csv", "tsv", "txt", "xlsx", "xls", "parquet", "npy"]
+# 上传的 .npy 矩阵与同一数值类型的 Parquet 宽表落盘为 .npy 后以内存映射方式读取，不整体载入内存
+MATRIX_CACHE_DIR = os.environ.get("ACADEMICVIZ_MATRIX_DIR",
+                                  os.path.join(os.path.expanduser("~"), ".cache", "academicviz", "matrix"))
+MATRIX_CACHE_MAX_FILES = 8
+
+
+def compact_frame(df, category_max_ratio=CATEGORY_MAX_RATIO):
+    """
+    就地压缩 DataFrame 内存：整数降为最小位宽，浮点数在无损时降为 float32，
+    低基数文本列 (如分组列) 转为 category。
+    """
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_integer_dtype(series.dtype):
+            df[col] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series.dtype):
+            as32 = series.astype(np.float32)
+            if np.array_equal(as32.to_numpy(dtype=np.float64), series.to_numpy(), equal_nan=True):
+                df[col] = as32
+        elif series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+            if len(series) and series.nunique(dropna=True) <= len(series) * category_max_ratio:
+                df[col] = series.astype('category')
+    return df
+
+
+def _concat_chunks(chunks):
+    """
+    按列合并分块结果，每合并一列就从各块中移除该列，峰值只多出一列的副本。
+    各块的 category 列用 union_categoricals 统一类别，避免退化为 object。
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    columns = {}
+    for col in list(chunks[0].columns):
+        parts = [chunk.pop(col) for chunk in chunks]
+        is_cat = [isinstance(part.dtype, pd.CategoricalDtype) for part in parts]
+        if all(is_cat):
+            columns[col] = pd.Series(pd.api.types.union_categoricals(parts), name=col)
+        else:
+            if any(is_cat):
+                parts = [part.astype(object) if cat else part for part, cat in zip(parts, is_cat)]
+            columns[col] = pd.concat(parts, ignore_index=True)
+        del parts
+    return pd.DataFrame(columns, copy=False)
+
+
+def _matrix_frame(matrix, file_name, columns=None):
+    """二维矩阵包装为 DataFrame，与矩阵 (可能是内存映射) 共享缓冲区 (copy=False)。"""
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(-1, 1)
+    if matrix.ndim != 2:
+        raise ValueError(f"只支持二维矩阵，{file_name} 的形状为 {matrix.shape}")
+    if columns is None:
+        columns = [f"C{i + 1}" for i in range(matrix.shape[1])]
+    return pd.DataFrame(matrix, columns=columns, copy=False)
+
+
+def _parquet_matrix_file(source, cache_key):
+    """
+    所有列为同一数值类型的 Parquet (表达矩阵等宽表) 按行组、分批列流式写成 .npy 缓存，返回 (路径, 列名)；
+    之后与 .npy 一样内存映射读取，峰值内存只多出约 HEATMAP_CHUNK_ELEMENTS 个元素。其他表返回 None，按普通表读取。
+    Parquet 数据页需要解码，直接 memory_map 读取仍会把解码结果整体放进内存，因此转存为 .npy。
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(source, memory_map=isinstance(source, (str, os.PathLike)))
+    schema, meta = pf.schema_arrow, pf.metadata
+    types = set(schema.types)
+    if len(types) != 1 or meta.num_rows == 0:
+        return None
+    arrow_type = types.pop()
+    if pa.types.is_integer(arrow_type):
+        # 整数列含缺失值时无法原样放进整数矩阵
+        for i in range(meta.num_row_groups):
+            for j in range(meta.num_columns):
+                stats = meta.row_group(i).column(j).statistics
+                if stats is None or not stats.has_null_count or stats.null_count:
+                    return None
+    elif not pa.types.is_floating(arrow_type):
+        return None
+
+    path = os.path.join(MATRIX_CACHE_DIR, f"{cache_key}.npy")
+    if not os.path.exists(path):
+        os.makedirs(MATRIX_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=arrow_type.to_pandas_dtype(),
+                                        shape=(meta.num_rows, len(schema)))
+        start = 0
+        for i in range(meta.num_row_groups):
+            # iter_batches 会解码整个行组，按列分批读取才能限制峰值
+            stop = start + meta.row_group(i).num_rows
+            step = max(1, HEATMAP_CHUNK_ELEMENTS // max(stop - start, 1))
+            for j in range(0, len(schema), step):
+                part = pf.read_row_group(i, columns=schema.names[j:j + step])
+                for k, column in enumerate(part.columns):
+                    out[start:stop, j + k] = column.to_numpy()
+                del part
+            start = stop
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+    _prune_matrix_cache(path)
+    return path, list(schema.names)
+
+
+@perf_timed("ingest")
+def read_table(source, file_name, sep=None, chunk_rows=INGEST_CHUNK_ROWS, content_hash=None):
+    """
+    读取 CSV / TSV / XLSX / Parquet / NPY 为压缩后的 DataFrame。
+    文本格式按块解析，每块解析后立即压缩类型，峰值内存只多出一个原始块。
+    source 可以是路径或文件对象；sep 为 None 时按扩展名或首行内容推断分隔符。
+    content_hash 为文件对象的内容哈希，用于命名 Parquet 矩阵的 .npy 缓存 (路径来源按路径与修改时间命名)。
+    """
+    ext = os.path.splitext(file_name)[1].lower()
+    is_path = isinstance(source, (str, os.PathLike))
+    if ext == '.npy':
+        # 路径来源直接内存映射
+        return _matrix_frame(np.load(source, mmap_mode='r' if is_path else None), file_name)
+    if ext in ('.parquet', '.pq'):
+        if is_path and content_hash is None:
+            stat = os.stat(source)
+            content_hash = hashlib.sha1(f"{os.path.abspath(source)}|{stat.st_size}|{stat.st_mtime_ns}"
+                                        .encode("utf-8")).hexdigest()
+        matrix_file = _parquet_matrix_file(source, content_hash) if content_hash else None
+        if matrix_file is not None:
+            # 数值矩阵保持原类型与内存映射，不做 compact_frame
+            path, columns = matrix_file
+            return _matrix_frame(np.load(path, mmap_mode='r'), file_name, columns)
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        return compact_frame(pd.read_parquet(source, memory_map=is_path))
+    if ext in ('.xlsx', '.xls'):
+        return compact_frame(pd.read_excel(source))
+
+    if sep is None:
+        if ext in ('.tsv', '.tab'):
+            sep = '\t'
+        else:
+            if hasattr(source, 'seek'):
+                pos = source.tell()
+                head = source.readline()
+                source.seek(pos)
+            else:
+                with open(source, 'rb') as f:
+                    head = f.readline()
+            if isinstance(head, bytes):
+                head = head.decode('utf-8', errors='ignore')
+            sep = '\t' if '\t' in head else ','
+    reader = pd.read_csv(source, sep=sep, chunksize=chunk_rows)
+    return _concat_chunks([compact_frame(chunk) for chunk in reader])
+
+
+@st.cache_resource(max_entries=4)
+def load_uploaded_table(content_hash, file_name, _file):
+    """
+    按内容哈希缓存解析结果，重跑时不再重复解析。返回的 DataFrame 在会话间共享，使用方不得就地修改。
+    _file 直接使用上传控件的 BytesIO，不经 getbuffer() / 再包一层 BytesIO，避免复制整个文件。
+    """
+    _file.seek(0)
+    if file_name.lower().endswith('.npy'):
+        return read_table(_matrix_cache_file(content_hash, _file), file_name)
+    return read_table(_file, file_name, content_hash=content_hash)
+
+
+def _matrix_cache_file(content_hash, source):
+    """把上传的 .npy (文件对象) 写入磁盘缓存 (按内容哈希命名，已存在则复用)，只保留最近的若干个文件。"""
+    os.makedirs(MATRIX_CACHE_DIR, exist_ok=True)
+    path = os.path.join(MATRIX_CACHE_DIR, f"{content_hash}.npy")
+    if not os.path.exists(path):
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(source, f)
+        os.replace(tmp_path, path)
+    _prune_matrix_cache(path)
+    return path
+
+
+def _prune_matrix_cache(keep):
+    """矩阵缓存只保留最近的若干个文件 (keep 为当前使用的文件，不删除)。"""
+    files = sorted((os.path.join(MATRIX_CACHE_DIR, f) for f in os.listdir(MATRIX_CACHE_DIR) if f.endswith(".npy")),
+                   key=os.path.getmtime)
+    for stale in files[:-MATRIX_CACHE_MAX_FILES]:
+        if stale != keep:
+            os.remove(stale)
+
+
+@st.cache_resource(max_entries=8)
+def load_pasted_table(content_hash, _text):
+    """粘贴文本的解析结果缓存，沿用原有规则：含制表符按 TSV 解析，否则按 CSV。"""
+    return read_table(io.StringIO(_text), "pasted.txt", sep="\t" if "\t" in _text else ",")
+
+
+# --- 示例数据 ---
+@st.cache_data
+def load_demo_data(kind):
+    """生成示例数据；缓存后每次重跑得到相同的数据，渲染缓存才能命中。"""
+    if kind == "普通实验数据":
+        return pd.DataFrame({
+            'Group': ['Control', 'Treat_A', 'Treat_B'] * 5,
+            'Value': np.random.normal(10, 2, 15) + [0, 5, 3] * 5
+        })
+    elif kind == "Western Blot数据":
+        return pd.DataFrame({
+            'Sample': ['Ctrl', 'Drug_X', 'Drug_Y'],
+            'Target_Band': [1200, 2500, 1800],
+            'Loading_Control': [1000, 980, 1010]
+        })
+    elif kind == "临床生存数据":
+        return pd.DataFrame({
+            'Time': np.sort(np.random.randint(1, 100, 50)),
+            'Event': np.random.randint(0, 2, 50),
+            'Group': ['Placebo'] * 25 + ['Drug'] * 25
+        })
+    elif kind == "GIS地理数据":
+        return pd.DataFrame({
+            '公司名称': ['南宁物流A站', '青秀区分拨中心', '江南转运仓'],
+            '区域': ['兴宁区', '青秀区', '江南区'],
+            '纬度': [22.85, 22.81, 22.79],
+            '经度': [108.32, 108.36, 108.28],
+            '类型': ['分拨中心', '网点', '转运仓']
+        })
+    return None
 
 
 def main():
     # --- 页面配置 ---
     st.set_page_config(layout="wide", page_title="AcademicViz Pro - 论文图表工坊", page_icon="📊")
+    # 中文字体在后台解析 (必要时下载)，首屏不等待；绘图时才等待其完成
+    font_bootstrap = get_font_bootstrap()
 
     # --- 样式注入 ---
     st.markdown("""
@@ -129,13 +2788,38 @@ def main():
     </style>
     """, unsafe_allow_html=True)
 
+    # 调试面板开关在侧边栏底部绘制，这里先读取上一轮的取值，以便从本轮开始就统计内存
+    perf_debug = st.session_state.get("perf_debug", False)
+    with PerfRecorder(trace_memory=perf_debug) as perf:
+        with perf_stage("page"):
+            render_page(font_bootstrap)
+    st.sidebar.checkbox("🛠 性能调试面板", key="perf_debug",
+                        help="显示本次重跑各阶段的耗时与峰值内存；设置 ACADEMICVIZ_PERF_LOG 可同时输出 JSON 日志")
+    if perf_debug:
+        show_perf_panel(perf)
+
+
+def show_perf_panel(perf):
+    """调试面板：本次重跑的阶段汇总与明细 (缓存命中的阶段不会出现)。"""
+    with st.expander("🛠 性能调试 (本次重跑)", expanded=True):
+        summary = perf.summary()
+        page = summary.loc[summary["stage"] == "page", "total_ms"]
+        st.caption(f"页面脚本总耗时 {page.iat[0] if len(page) else 0:,.0f} ms；"
+                   f"渲染缓存 {get_render_cache().stats}；几何存储 {get_geometry_store().stats}")
+        st.dataframe(summary, hide_index=True)
+        st.dataframe(pd.DataFrame(perf.records), hide_index=True)
+        st.download_button("📥 导出 JSON", json.dumps(perf.records, ensure_ascii=False, default=str),
+                           "perf_stages.json", "application/json")
+
+
+def render_page(font_bootstrap):
+    """页面主体：数据输入、图表设置、预览与导出。"""
     # --- Session State 初始化 ---
-    if 'gis_data' not in st.session_state:
-        st.session_state.gis_data = None
-    if 'gis_geojson' not in st.session_state:
-        st.session_state.gis_geojson = None
-    if 'gis_density_map' not in st.session_state:
-        st.session_state.gis_density_map = None
+    # 会话中只保存边界键与模拟参数，几何与点位由进程级缓存共享
+    if 'gis_key' not in st.session_state:
+        st.session_state.gis_key = None
+    if 'gis_crawl' not in st.session_state:
+        st.session_state.gis_crawl = None
 
     # --- 主界面 ---
     st.title("📊 AcademicViz Pro - 论文图表可视化工具")
@@ -143,48 +2827,38 @@ def main():
     # Sidebar: 数据输入
     with st.sidebar:
         st.header("1. 数据输入 (Data Input)")
-        data_input_type = st.radio("数据来源", ["粘贴 Excel 数据", "加载示例数据"])
+        data_input_type = st.radio("数据来源", ["粘贴 Excel 数据", "上传数据文件", "加载示例数据"])
 
-        df = None
+        # data_key 为数据内容的哈希 (粘贴文本 / 上传文件) 或示例类型，作为各级缓存的数据键，
+        # 重跑时无需再逐行哈希整个 DataFrame
+        df, data_key = None, None
         if data_input_type == "粘贴 Excel 数据":
             raw_data = st.text_area("请直接粘贴 Excel 数据 (含表头)", height=150,
                                     placeholder="Group\tValue\tError\nControl\t1.0\t0.1\nTreat\t2.5\t0.2")
             if raw_data:
                 try:
-                    if "\t" in raw_data:
-                        df = pd.read_csv(io.StringIO(raw_data), sep="\t")
-                    else:
-                        df = pd.read_csv(io.StringIO(raw_data))
+                    data_key = hashlib.sha1(raw_data.encode("utf-8")).hexdigest()
+                    df = load_pasted_table(data_key, raw_data)
+                except Exception as e:
+                    st.error(f"数据解析失败: {e}")
+        elif data_input_type == "上传数据文件":
+            uploaded = st.file_uploader("上传 CSV / TSV / Excel / Parquet 文件", type=UPLOAD_TYPES)
+            if uploaded is not None:
+                try:
+                    # getvalue() 与上传控件共享缓冲区，不复制文件内容
+                    data_key = hashlib.sha1(uploaded.getvalue()).hexdigest()
+                    df = load_uploaded_table(data_key, uploaded.name, uploaded)
+                    st.caption(f"{len(df):,} 行 × {df.shape[1]} 列，内存占用 "
+                               f"{df.memory_usage(deep=True).sum() / 1024 ** 2:.1f} MB (文件 {uploaded.size / 1024 ** 2:.1f} MB)")
+                except ImportError as e:
+                    st.error(f"缺少读取该格式所需的依赖: {e}")
                 except Exception as e:
                     st.error(f"数据解析失败: {e}")
         else:
             data_type_demo = st.selectbox("选择示例类型",
                                           ["普通实验数据", "Western Blot数据", "临床生存数据", "GIS地理数据"])
-            if data_type_demo == "普通实验数据":
-                df = pd.DataFrame({
-                    'Group': ['Control', 'Treat_A', 'Treat_B'] * 5,
-                    'Value': np.random.normal(10, 2, 15) + [0, 5, 3] * 5
-                })
-            elif data_type_demo == "Western Blot数据":
-                df = pd.DataFrame({
-                    'Sample': ['Ctrl', 'Drug_X', 'Drug_Y'],
-                    'Target_Band': [1200, 2500, 1800],
-                    'Loading_Control': [1000, 980, 1010]
-                })
-            elif data_type_demo == "临床生存数据":
-                df = pd.DataFrame({
-                    'Time': np.sort(np.random.randint(1, 100, 50)),
-                    'Event': np.random.randint(0, 2, 50),
-                    'Group': ['Placebo'] * 25 + ['Drug'] * 25
-                })
-            elif data_type_demo == "GIS地理数据":
-                df = pd.DataFrame({
-                    '公司名称': ['南宁物流A站', '青秀区分拨中心', '江南转运仓'],
-                    '区域': ['兴宁区', '青秀区', '江南区'],
-                    '纬度': [22.85, 22.81, 22.79],
-                    '经度': [108.32, 108.36, 108.28],
-                    '类型': ['分拨中心', '网点', '转运仓']
-                })
+            df = load_demo_data(data_type_demo)
+            data_key = render_key('demo', data_type_demo)
 
         if df is not None:
             st.dataframe(df.head(3), height=100)
@@ -211,8 +2885,7 @@ def main():
         with col_cfg3:
             y_label = st.text_input("Y轴标签", "纬度 (Latitude)")
 
-        # 使用 font_properties 确保标题不乱码
-        fig, ax = plt.subplots(figsize=(10, 8))
+        render_result = None
 
         # ==========================
         # 逻辑分支：GIS 地图模式
@@ -226,174 +2899,152 @@ def main():
                 st.markdown("#### 数据源配置")
                 # 升级：支持输入名称、Adcode 或 URL
                 region_input = st.text_input("地区名称 / Adcode / URL", "南宁市",
-                                             help="支持输入：\n1. 中文名称 (如：长沙、南宁)\n2. 6位 Adcode (如：430100)\n3. 完整 GeoJSON URL")
+                                             help="支持输入：\n1. 地区名称，可省略省/市/区/县后缀，支持拼音与带上级的写法 (如：长沙、nanning、深圳南山区)\n2. 6位 Adcode (如：430100)\n3. 完整 GeoJSON URL"
+                                                  "\n4. 多个地区，用逗号分隔 (如：南宁, 柳州)\n5. 地区名后加 /* 表示全部下级 (如：广西/*)")
                 target_keywords = st.text_input("爬取关键词", "物流公司, 分拨中心")
+                offline_mode = st.checkbox("离线模式 (仅使用本地缓存/预置边界)", value=False,
+                                           help="可通过环境变量 ACADEMICVIZ_GEOJSON_DIR 指定预置 GeoJSON 目录")
+                with st.expander("模拟爬取参数"):
+                    crawl_seed = st.number_input("随机种子", min_value=0, value=0, step=1,
+                                                 help="相同种子与地区得到完全相同的模拟结果")
+                    crawl_rate = st.number_input("每区平均点位数", min_value=0, max_value=CRAWL_MAX_POINTS, value=0, step=10,
+                                                 help="0 表示每区随机 1~15 个；设为较大值可生成百万级点位用于压力测试，"
+                                                      f"总点位 (每区点位数 × 区域数) 不超过 {CRAWL_MAX_POINTS:,}")
+                    crawl_inside = st.checkbox("点位限定在所属区域内", value=True)
 
                 if st.button("🔍 获取地图并爬取数据", type="primary"):
-                    map_url, resolved_name = resolve_map_url(region_input)
+                    targets, unresolved = resolve_regions(region_input)
+                    resolved_name = "、".join(name for _, name, _ in targets)
 
-                    if not map_url:
+                    if unresolved:
+                        st.warning(f"无法识别: {'、'.join(unresolved)}，请检查拼写或直接输入 Adcode。")
+                    if not targets:
                         st.error("无法识别该地区，请检查拼写或直接输入 Adcode。")
                     else:
                         with st.spinner(f"正在请求 {resolved_name} 地图数据并模拟爬取..."):
                             try:
-                                resp = requests.get(map_url)
-                                if resp.status_code == 200:
-                                    geojson_data = resp.json()
-                                    st.session_state.gis_geojson = geojson_data
-
-                                    crawled_rows = []
-                                    density_map = {}
-
-                                    features = geojson_data.get('features', [])
-                                    company_suffixes = ["物流有限公司", "供应链管理公司", "配送中心", "分拣站",
-                                                        "转运中心"]
-
-                                    for feature in features:
-                                        props = feature.get('properties', {})
-                                        name = props.get('name', '未知区域')
-                                        center = props.get('center')
-
-                                        # 如果没有 center，计算几何中心作为临时 center
-                                        if not center and feature['geometry']['type'] in ['Polygon', 'MultiPolygon']:
-                                            # 简易计算：所有点的平均值
-                                            coords = []
-                                            if feature['geometry']['type'] == 'Polygon':
-                                                coords = feature['geometry']['coordinates'][0]
-                                            elif feature['geometry']['type'] == 'MultiPolygon':
-                                                coords = feature['geometry']['coordinates'][0][0]
-
-                                            if coords:
-                                                mean_x = np.mean([p[0] for p in coords])
-                                                mean_y = np.mean([p[1] for p in coords])
-                                                center = [mean_x, mean_y]
-
-                                        if not center: continue
-
-                                        count = random.randint(1, 15)
-                                        density_map[name] = count
-
-                                        for i in range(count):
-                                            lat = center[1] + random.gauss(0, 0.03)
-                                            lon = center[0] + random.gauss(0, 0.03)
-
-                                            comp_name = f"{name}{random.choice(['安能', '中通', '顺丰', '京东', '圆通'])}{random.choice(company_suffixes)}"
-                                            if i % 3 == 0:
-                                                comp_name = f"{name}第{i + 1}分拨站"
-
-                                            crawled_rows.append({
-                                                '公司名称': comp_name,
-                                                '区域': name,
-                                                '纬度': lat,
-                                                '经度': lon,
-                                                '类型': '站点'
-                                            })
-
-                                    st.session_state.gis_data = pd.DataFrame(crawled_rows)
-                                    st.session_state.gis_density_map = density_map
+                                gis_key = regions_cache_key(targets)
+                                store = get_geometry_store()
+                                geometry = store.get(gis_key, max_age=GEOMETRY_MAX_AGE, complete=True)
+                                source = "几何存储"
+                                if geometry is None:
+                                    geojson_data, fetch_report = fetch_regions(targets, get_boundary_cache(offline_mode))
+                                    failed = [r for r in fetch_report if r["error"]]
+                                    if failed:
+                                        st.warning(f"{len(failed)} / {len(fetch_report)} 个地区边界获取失败："
+                                                   + "；".join(f"{r['region']} ({r['error']})" for r in failed))
+                                    source = "、".join(sorted({r["source"] for r in fetch_report if r["source"]})) or "无"
+                                    if geojson_data["features"]:
+                                        # 部分失败的结果只留在内存、不落盘，并标记为部分结果：
+                                        # 重跑时照常展示，下次点击获取时视为未命中，重新请求失败的地区
+                                        geometry = store.put(gis_key, geojson_data, persist=not failed)
+                                n_regions = len(geometry.properties) if geometry is not None else 0
+                                if geometry is not None and crawl_rate * n_regions > CRAWL_MAX_POINTS:
+                                    # 在写入会话与进程级缓存之前拦截，避免一次生成数十亿行
+                                    st.error(f"{n_regions:,} 个区域 × 每区 {int(crawl_rate):,} 个点位超过总点位上限 "
+                                             f"{CRAWL_MAX_POINTS:,}，请将每区平均点位数降到 "
+                                             f"{CRAWL_MAX_POINTS // n_regions:,} 以下。")
+                                elif geometry is not None:
+                                    crawl = (int(crawl_seed), int(crawl_rate), bool(crawl_inside))
+                                    st.session_state.gis_key = gis_key
+                                    st.session_state.gis_crawl = crawl
+                                    crawled_df, _ = get_simulated_crawl(gis_key, *crawl, geometry)
                                     st.success(
-                                        f"成功加载 {resolved_name} 地图! 包含 {len(features)} 个区域，爬取 {len(crawled_rows)} 条数据。")
+                                        f"成功加载 {resolved_name} 地图 (来源: {source})! 包含 {len(geometry.properties)} 个区域，爬取 {len(crawled_df):,} 条数据。")
                                 else:
-                                    st.error(
-                                        f"地图数据请求失败 (HTTP {resp.status_code})。可能是 Adcode 不存在或 DataV 接口变更。")
+                                    st.error("地图数据请求失败，未获得任何边界。可能是 Adcode 不存在或 DataV 接口变更。")
                             except Exception as e:
                                 st.error(f"发生错误: {e}")
 
-                if st.session_state.gis_data is not None:
+                cache_stats = get_boundary_cache(offline_mode).stats
+                st.caption("边界缓存: 命中 {hits} / 未命中 {misses} / 重新验证 {revalidated} / 预置 {seeded} / 过期回退 {stale}"
+                           .format(**cache_stats))
+
+                gis_key = st.session_state.gis_key
+                geometry = get_geometry_store().get(gis_key) if gis_key else None
+                crawled_df, crawl_density = None, {}
+                if geometry is not None and st.session_state.gis_crawl is not None:
+                    crawled_df, crawl_density = get_simulated_crawl(gis_key, *st.session_state.gis_crawl, geometry)
+                elif gis_key:
+                    st.info("地图数据已从缓存中淘汰，请重新点击上方按钮获取。")
+
+                if crawled_df is not None:
                     with st.expander("📄 查看爬取结果 (含具体名称)", expanded=True):
-                        st.dataframe(st.session_state.gis_data.head(10))
-                        csv = st.session_state.gis_data.to_csv(index=False).encode('utf-8_sig')
+                        st.dataframe(crawled_df.head(10))
+                        csv = crawled_df.to_csv(index=False).encode('utf-8_sig')
                         st.download_button("📥 导出CSV", csv, "logistics_points.csv", "text/csv")
 
+                # 点位来源：模拟爬取结果，或左侧数据表中带经纬度列的数据
+                lonlat_cols = detect_lonlat_columns(df) if df is not None else None
+                point_sources = ["模拟爬取结果"] + (["左侧数据表"] if lonlat_cols else [])
+                point_source = st.radio("点位数据来源", point_sources, horizontal=True)
+                if point_source == "左侧数据表":
+                    points_df = df
+                    lon_col, lat_col = lonlat_cols
+                    points_key = data_key
+                else:
+                    points_df = crawled_df
+                    lon_col, lat_col = '经度', '纬度'
+                    points_key = render_key('crawl', gis_key, st.session_state.gis_crawl)
+                name_col = None
+                value_cols = []
+                if points_df is not None:
+                    text_cols = [c for c in points_df.columns if c not in (lon_col, lat_col)
+                                 and not pd.api.types.is_numeric_dtype(points_df[c])]
+                    name_col = '公司名称' if '公司名称' in points_df.columns else (text_cols[0] if text_cols else None)
+                    value_cols = [c for c in points_df.select_dtypes('number').columns if c not in (lon_col, lat_col)]
+                metric = st.selectbox("区域着色指标", ["计数", "求和", "均值"] if value_cols else ["计数"],
+                                      help="按点位所在行政区 (点落区空间连接) 汇总")
+                value_col = st.selectbox("统计字段", value_cols) if metric != "计数" else None
+
                 st.markdown("---")
                 st.markdown("**绘图风格配置**")
                 cmap_name = st.selectbox("密度色系", ["Blues", "Oranges", "Reds", "Greens", "Purples"])
                 # 默认开启显示区域名称
                 show_labels = st.checkbox("显示区域名称", value=True)
+                simplify_boundaries = st.checkbox("自适应简化边界 (按输出分辨率)", value=True,
+                                                  help="去除在 300 dpi 导出尺寸下不可见的顶点，公共边界保持无缝")
                 show_points = st.checkbox("显示具体点位 (散点)", value=True)
+                point_mode = st.selectbox("点位渲染方式", POINT_RENDER_MODES,
+                                          help=f"自动：超过 {POINT_AGGREGATE_THRESHOLD:,} 个点时改为按输出分辨率聚合的密度栅格")
                 # 默认关闭点位名称显示
                 show_point_labels = st.checkbox("显示点位名称 (公司名)", value=False)
+                point_label_budget = st.slider("点位名称数量上限", 10, 500, 50, step=10,
+                                               disabled=not show_point_labels,
+                                               help="按优先级放置并自动避让重叠，超出上限或无处可放的名称不显示")
 
             with gis_col2:
-                if st.session_state.gis_geojson:
+                if geometry is not None:
+                    raw_geojson = geometry.geojson
+                    how = {"计数": "count", "求和": "sum", "均值": "mean"}[metric]
                     try:
-                        # 确保标题使用中文字体
-                        ax.set_title(plot_title, fontsize=18, pad=20, fontproperties=font_prop)
-
-                        features = st.session_state.gis_geojson.get('features', [])
-                        density_map = st.session_state.gis_density_map or {}
-
-                        max_val = max(density_map.values()) if density_map else 1
-                        cmap = plt.get_cmap(cmap_name)
-
-                        # 1. 绘制行政区划 (密度背景)
-                        for feature in features:
-                            name = feature['properties'].get('name')
-                            geometry = feature['geometry']
-                            coords_list = []
-
-                            if geometry['type'] == 'Polygon':
-                                coords_list = [geometry['coordinates'][0]]
-                            elif geometry['type'] == 'MultiPolygon':
-                                for poly in geometry['coordinates']:
-                                    coords_list.append(poly[0])
-
-                            val = density_map.get(name, 0)
-                            color = cmap(val / max_val * 0.8 + 0.1)
-
-                            current_poly_center = None
-                            all_x_coords = []
-                            all_y_coords = []
-
-                            for coords in coords_list:
-                                poly = MplPolygon(coords, closed=True, facecolor=color, edgecolor='#666', linewidth=0.8)
-                                ax.add_patch(poly)
-                                # 收集坐标以便计算中心
-                                for p in coords:
-                                    all_x_coords.append(p[0])
-                                    all_y_coords.append(p[1])
-
-                            if show_labels:
-                                # 优先使用 Properties 里的 center
-                                center = feature['properties'].get('center')
-
-                                # 如果没有预设 Center，则计算几何中心 (平均值)
-                                if not center and all_x_coords:
-                                    center = [np.mean(all_x_coords), np.mean(all_y_coords)]
-
-                                if center:
-                                    ax.text(center[0], center[1], name, ha='center', va='center',
-                                            fontsize=9, color='#333', fontweight='bold', fontproperties=font_prop)
-
-                        # 2. 绘制具体点位 (前景)
-                        if show_points and st.session_state.gis_data is not None:
-                            points_df = st.session_state.gis_data
-                            sc = ax.scatter(points_df['经度'], points_df['纬度'], c='#FF9800', s=30, marker='^',
-                                            edgecolors='white', linewidth=0.5, label='物流站点', zorder=10)
-
-                            # 仅当勾选时才显示点位名称
-                            if show_point_labels:
-                                for idx, row in points_df.iterrows():
-                                    if idx % 5 == 0:
-                                        ax.text(row['经度'], row['纬度'] + 0.005, row['公司名称'],
-                                                fontsize=7, color='#d35400', ha='center', fontproperties=font_prop)
-
-                        sm = plt.cm.ScalarMappable(cmap=cmap, norm=plt.Normalize(vmin=0, vmax=max_val))
-                        sm.set_array([])
-                        cbar = plt.colorbar(sm, ax=ax, fraction=0.03, pad=0.04)
-                        cbar.set_label("企业数量密度", fontsize=10, fontproperties=font_prop)
-
-                        # 指北针
-                        ax.text(0.95, 0.95, 'N', transform=ax.transAxes, ha='center', fontsize=16, fontweight='bold')
-                        ax.arrow(0.95, 0.90, 0, 0.08, transform=ax.transAxes, head_width=0.02, head_length=0.03, fc='k',
-                                 ec='k')
-
-                        ax.autoscale()
-                        ax.set_aspect('equal')
-                        ax.axis('off')
-
-                        st.pyplot(fig)
+                        if points_df is not None:
+                            # 区域数值由点位空间连接得到，真实反映点位分布
+                            density_map = get_district_values(gis_key, points_key, how, value_col, raw_geojson,
+                                                              points_df, lon_col, lat_col)
+                        else:
+                            density_map = crawl_density
+                    except Exception as e:
+                        st.error(f"空间连接失败: {e}")
+                        density_map = {}
+                    if how == "count":
+                        density_label = "企业数量密度" if point_source == "模拟爬取结果" else "点位数量"
+                    else:
+                        density_label = f"{value_col} ({metric})"
 
+                    def draw_gis(fig, ax):
+                        render_gis_map(fig, ax, raw_geojson, gis_key, density_map, points_df, lon_col, lat_col,
+                                       name_col=name_col, title=plot_title, cmap_name=cmap_name,
+                                       density_label=density_label, show_labels=show_labels,
+                                       simplify=simplify_boundaries, show_points=show_points, point_mode=point_mode,
+                                       show_point_labels=show_point_labels, label_budget=point_label_budget)
+
+                    try:
+                        key = render_key('gis', gis_key, point_source, points_key, how, value_col, plot_title, cmap_name,
+                                         show_labels, simplify_boundaries, show_points, point_mode, show_point_labels,
+                                         point_label_budget)
+                        render_result = get_render_cache().get(key, draw_gis, pinned=(points_df, geometry))
+                        st.image(render_result.preview_png)
                     except Exception as e:
                         st.error(f"绘图错误: {e}")
                 else:
@@ -407,55 +3058,78 @@ def main():
                 st.warning("此类图表需要先在左侧输入数据。")
             else:
                 cols = df.columns.tolist()
-                col_x = st.selectbox("选择 X 轴数据", cols, index=0)
-                col_y = st.selectbox("选择 Y 轴数据", cols, index=1 if len(cols) > 1 else 0)
-                col_group = st.selectbox("选择分组 (可选)", ["无"] + cols, index=0)
-
-                sns.set_style("ticks")
-                sns.set_context("paper", font_scale=1.2)
+                if chart_type == '生存曲线 (Survival Plot)':
+                    col_x = st.selectbox("时间列 (Time)", cols, index=guess_column(cols, SURVIVAL_TIME_NAMES, 0))
+                    col_y = st.selectbox("事件列 (Event，1 = 发生，0 = 删失)", cols,
+                                         index=guess_column(cols, SURVIVAL_EVENT_NAMES, min(1, len(cols) - 1)))
+                    group_idx = guess_column(cols, SURVIVAL_GROUP_NAMES, -1) + 1
+                    col_group = st.selectbox("选择分组 (可选)", ["无"] + cols, index=group_idx)
+                elif chart_type == '热图 (Heatmap)':
+                    # 热图使用全部数值列，首个文本列作为行名
+                    col_x = col_y = None
+                    col_group = "无"
+                else:
+                    col_x = st.selectbox("选择 X 轴数据", cols, index=0)
+                    col_y = st.selectbox("选择 Y 轴数据", cols, index=1 if len(cols) > 1 else 0)
+                    col_group = st.selectbox("选择分组 (可选)", ["无"] + cols, index=0)
+
+                hue = None if col_group == "无" else col_group
+                plot_df = df
+                error_bar = None
+                point_mode = None
+                cluster = (False, False, 'euclidean')
+                if chart_type in ('柱状图 (Bar Plot)', '折线图 (Line Plot)'):
+                    if chart_type == '柱状图 (Bar Plot)' and "Target_Band" in df.columns and "Loading_Control" in df.columns:
+                        plot_df = df.assign(Relative_Density=df['Target_Band'] / df['Loading_Control'])
+                        col_y = 'Relative_Density'
+                        # 派生列由源数据唯一确定，键取源数据键加派生列名
+                        data_key = render_key(data_key, col_y)
+                    error_bar = st.radio("误差线格式", ["sd (标准差)", "se (标准误)", "ci (95% 置信区间，自助法)"],
+                                         index=0).split()[0]
+                elif chart_type == '散点图 (Scatter Plot)':
+                    point_mode = st.selectbox("点位渲染方式", POINT_RENDER_MODES,
+                                              help=f"自动：超过 {POINT_AGGREGATE_THRESHOLD:,} 个点时改为密度栅格 (不区分分组)")
+                elif chart_type == '热图 (Heatmap)':
+                    col_h1, col_h2, col_h3 = st.columns(3)
+                    cluster = (col_h1.checkbox("行聚类"), col_h2.checkbox("列聚类"),
+                               col_h3.selectbox("聚类距离", HEATMAP_CLUSTER_METRICS))
+                    st.caption(f"矩阵 {len(df):,} 行，超出导出像素网格时按块平均显示；"
+                               f"超过 {CLUSTER_EXACT_MAX:,} 行/列时先 k-means 分组再层次聚类")
 
                 try:
-                    if chart_type == '柱状图 (Bar Plot)':
-                        if "Target_Band" in df.columns and "Loading_Control" in df.columns:
-                            df['Relative_Density'] = df['Target_Band'] / df['Loading_Control']
-                            col_y = 'Relative_Density'
-                        error_bar = st.radio("误差线格式", ["sd (标准差)", "se (标准误)"], index=0)
-                        sns.barplot(data=df, x=col_x, y=col_y, hue=None if col_group == "无" else col_group,
-                                    capsize=.1, errorbar=error_bar.split()[0], ax=ax, palette="viridis")
-                    elif chart_type == '折线图 (Line Plot)':
-                        sns.lineplot(data=df, x=col_x, y=col_y, hue=None if col_group == "无" else col_group,
-                                     marker='o', errorbar='sd', ax=ax)
-                    elif chart_type == '散点图 (Scatter Plot)':
-                        sns.scatterplot(data=df, x=col_x, y=col_y, hue=None if col_group == "无" else col_group, ax=ax)
-
-                    # 确保常规图表也使用中文字体
-                    ax.set_title(plot_title, fontproperties=font_prop)
-                    ax.set_xlabel(x_label, fontproperties=font_prop)
-                    ax.set_ylabel(y_label, fontproperties=font_prop)
-
-                    # 设置坐标轴刻度字体
-                    for label in ax.get_xticklabels() + ax.get_yticklabels():
-                        label.set_fontproperties(font_prop)
-
-                    sns.despine()
-                    st.pyplot(fig)
+                    def draw_chart(fig, ax):
+                        render_chart(fig, ax, plot_df, chart_type, col_x, col_y, hue=hue, error_bar=error_bar,
+                                     point_mode=point_mode, title=plot_title, x_label=x_label, y_label=y_label,
+                                     data_key=data_key, cluster_rows=cluster[0], cluster_cols=cluster[1],
+                                     cluster_metric=cluster[2])
+
+                    key = render_key(chart_type, data_key, col_x, col_y, hue, error_bar, point_mode, cluster,
+                                     plot_title, x_label, y_label)
+                    render_result = get_render_cache().get(key, draw_chart, pinned=(plot_df,))
+                    st.image(render_result.preview_png)
+                    if chart_type == '生存曲线 (Survival Plot)':
+                        logrank = get_survival_analysis(data_key, col_x, col_y, hue, plot_df)['logrank']
+                        if logrank is not None:
+                            st.caption("Log-rank 检验: χ² = {:.3f}，自由度 = {}，p = {:.4g}".format(*logrank))
                 except Exception as e:
                     st.error(f"绘图出错: {str(e)}")
 
+        if font_bootstrap.done() and font_bootstrap.error:
+            st.warning(f"中文字体不可用: {font_bootstrap.error}，图表中文可能无法显示。")
+
         # --- 4. 导出设置 ---
         st.markdown("### 4. 导出 (Export)")
-        col_dl1, col_dl2 = st.columns(2)
-        img_buffer_png = io.BytesIO()
-        fig.savefig(img_buffer_png, format='png', dpi=300, bbox_inches='tight')
-        img_buffer_png.seek(0)
-        img_buffer_svg = io.BytesIO()
-        fig.savefig(img_buffer_svg, format='svg', bbox_inches='tight')
-        img_buffer_svg.seek(0)
-
-        with col_dl1:
-            st.download_button("📥 下载 PNG", data=img_buffer_png, file_name="figure.png", mime="image/png")
-        with col_dl2:
-            st.download_button("📥 下载 SVG", data=img_buffer_svg, file_name="figure.svg", mime="image/svg+xml")
+        if render_result is None:
+            st.caption("生成图表后即可导出。")
+        else:
+            # 导出文件在点击下载时才生成 (300 dpi)，并随渲染缓存复用
+            col_dl1, col_dl2 = st.columns(2)
+            with col_dl1:
+                st.download_button("📥 下载 PNG", data=lambda: render_result.export('png'), file_name="figure.png",
+                                   mime="image/png", on_click="ignore")
+            with col_dl2:
+                st.download_button("📥 下载 SVG", data=lambda: render_result.export('svg'), file_name="figure.svg",
+                                   mime="image/svg+xml", on_click="ignore")
 
 
 # --- 辅助函数：智能推荐 ---
@@ -465,8 +3139,500 @@ def recommend_chart(df):
     return '散点图 (Scatter Plot)'
 
 
+LON_COLUMN_NAMES = ('经度', 'lon', 'lng', 'longitude')
+LAT_COLUMN_NAMES = ('纬度', 'lat', 'latitude')
+
+
+def detect_lonlat_columns(df):
+    """识别经纬度列，返回 (经度列, 纬度列)；未找到返回 None。优先精确匹配列名，其次包含匹配。"""
+    names = {col: str(col).strip().lower() for col in df.columns}
+
+    def find(candidates):
+        for col, name in names.items():
+            if name in candidates:
+                return col
+        for col, name in names.items():
+            if any(c in name for c in candidates):
+                return col
+        return None
+
+    lon, lat = find(LON_COLUMN_NAMES), find(LAT_COLUMN_NAMES)
+    return (lon, lat) if lon is not None and lat is not None and lon != lat else None
+
+
+# --- 批量渲染 (命令行，无需 Streamlit 界面) ---
+SPEC_SUFFIXES = ('.json', '.yaml', '.yml')
+GIS_METRICS = {'count': '计数', 'sum': '求和', 'mean': '均值'}
+POINT_MODE_ALIASES = {'auto': '自动', 'all': '全部点位', 'density': '聚合栅格'}
+
+
+def load_spec_file(path):
+    """读取一个规格文件 (JSON 或 YAML)，返回规格字典列表；文件内容可以是单个字典或字典列表。"""
+    with open(path, encoding='utf-8') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError as e:
+                raise ImportError("读取 YAML 规格需要安装 PyYAML (pip install pyyaml)") from e
+            specs = yaml.safe_load(f)
+        else:
+            specs = json.load(f)
+    return specs if isinstance(specs, list) else [specs]
+
+
+def collect_render_jobs(spec_path, out_dir, formats=None):
+    """
+    把规格文件或规格目录展开为渲染任务列表 [(spec, spec_dir, output_base), ...]。
+    输出文件名取规格中的 output，缺省为规格文件名 (列表中的第 i 个规格追加 _i)。
+    """
+    if os.path.isdir(spec_path):
+        files = sorted(os.path.join(spec_path, name) for name in os.listdir(spec_path)
+                       if name.lower().endswith(SPEC_SUFFIXES))
+    else:
+        files = [spec_path]
+    jobs = []
+    for path in files:
+        specs = load_spec_file(path)
+        stem = os.path.splitext(os.path.basename(path))[0]
+        for i, spec in enumerate(specs):
+            spec = dict(spec)
+            if formats:
+                spec['formats'] = formats
+            name = spec.get('output') or (stem if len(specs) == 1 else f"{stem}_{i + 1}")
+            jobs.append((spec, os.path.dirname(os.path.abspath(path)), os.path.join(out_dir, name)))
+    return jobs
+
+
+_SPEC_TABLES = OrderedDict()
+
+
+def _load_spec_table(path):
+    """规格引用的数据文件：同一 worker 内按 (路径, 修改时间) 缓存，多个规格共用一份数据时只解析一次。"""
+    key = (path, os.path.getmtime(path))
+    if key not in _SPEC_TABLES:
+        _SPEC_TABLES[key] = read_table(path, path)
+        while len(_SPEC_TABLES) > 4:
+            _SPEC_TABLES.popitem(last=False)
+    return _SPEC_TABLES[key]
+
+
+def _spec_path(spec_dir, value):
+    return value if os.path.isabs(value) or '://' in value else os.path.join(spec_dir, value)
+
+
+def build_spec_draw(spec, spec_dir):
+    """把一个规格解析成绘图函数 draw(fig, ax)。数据与边界在此加载，绘图阶段不再做 I/O。"""
+    chart = spec.get('chart', 'bar')
+    point_mode = spec.get('point_mode', 'auto')
+    point_mode = POINT_MODE_ALIASES.get(point_mode, point_mode)
+    if CHART_TYPES.get(chart, chart) not in CHART_TYPES.values():
+        raise ValueError(f"不支持的图表类型: {chart} (可选: {', '.join(CHART_TYPES)})")
+    df = _load_spec_table(_spec_path(spec_dir, spec['data'])) if spec.get('data') else None
+
+    if CHART_TYPES.get(chart, chart) != CHART_TYPES['gis']:
+        if df is None:
+            raise ValueError("常规图表需要 data 字段指定数据文件")
+        cols = df.columns.tolist()
+        # 生存曲线也可写作 time / event / group
+        x = spec.get('x', spec.get('time', cols[0]))
+        y = spec.get('y', spec.get('event', cols[1] if len(cols) > 1 else cols[0]))
+        hue = spec.get('hue', spec.get('group'))
+        if CHART_TYPES.get(chart, chart) == CHART_TYPES['heatmap']:
+            x = y = ''  # 热图使用全部数值列，默认不加轴标题
+
+        def draw(fig, ax):
+            render_chart(fig, ax, df, chart, x, y, hue=hue, error_bar=spec.get('error_bar', 'sd'),
+                         point_mode=point_mode, title=spec.get('title', ''),
+                         x_label=spec.get('x_label', x), y_label=spec.get('y_label', y),
+                         cluster_rows=bool(spec.get('cluster_rows')), cluster_cols=bool(spec.get('cluster_cols')),
+                         cluster_metric=spec.get('cluster_metric', 'euclidean'))
+        return draw
+
+    # GIS：边界来自本地 GeoJSON 文件 (geojson) 或地区名称 / Adcode / URL (region)
+    if spec.get('geojson'):
+        geojson_path = _spec_path(spec_dir, spec['geojson'])
+        with open(geojson_path, encoding='utf-8') as f:
+            geojson = json.load(f)
+        cache_key = 'file-' + hashlib.sha1(os.path.abspath(geojson_path).encode('utf-8')).hexdigest()
+    else:
+        targets, unresolved = resolve_regions(str(spec.get('region', '')))
+        if unresolved or not targets:
+            raise ValueError(f"无法识别地区: {'、'.join(unresolved) or spec.get('region')}")
+        geojson, report = fetch_regions(targets, get_boundary_cache(bool(spec.get('offline', False))))
+        failed = [f"{r['region']} ({r['error']})" for r in report if r['error']]
+        if failed:
+            raise RuntimeError(f"边界获取失败: {'；'.join(failed)}")
+        cache_key = regions_cache_key(targets)
+
+    how = spec.get('metric', 'count')
+    if how not in GIS_METRICS:
+        raise ValueError(f"不支持的区域着色指标: {how} (可选: {', '.join(GIS_METRICS)})")
+    value_col = spec.get('value') if how != 'count' else None
+    density_map, lon_col, lat_col, name_col = {}, None, None, None
+    if df is not None:
+        lonlat_cols = detect_lonlat_columns(df)
+        lon_col = spec.get('lon', lonlat_cols[0] if lonlat_cols else None)
+        lat_col = spec.get('lat', lonlat_cols[1] if lonlat_cols else None)
+        if lon_col is None or lat_col is None:
+            raise ValueError("点位数据中未找到经纬度列，请在规格中用 lon / lat 指定")
+        name_col = spec.get('label')
+        density_map = get_district_values(cache_key, data_fingerprint(df), how, value_col, geojson,
+                                          df, lon_col, lat_col)
+    density_label = spec.get('density_label') or ("点位数量" if how == 'count' else f"{value_col} ({GIS_METRICS[how]})")
+
+    def draw(fig, ax):
+        render_gis_map(fig, ax, geojson, cache_key, density_map, df, lon_col, lat_col, name_col=name_col,
+                       title=spec.get('title', ''), cmap_name=spec.get('cmap', 'Blues'), density_label=density_label,
+                       show_labels=spec.get('show_labels', True), simplify=spec.get('simplify', True),
+                       show_points=spec.get('show_points', df is not None), point_mode=point_mode,
+                       show_point_labels=spec.get('show_point_labels', False),
+                       label_budget=spec.get('label_budget', 50))
+    return draw
+
+
+def save_figure(draw, output_base, formats=('png',), dpi=EXPORT_DPI, figsize=RENDER_FIGSIZE):
+    """绘制一次，按各格式保存为 output_base.<fmt>，返回输出路径列表。"""
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=figsize)
+    try:
+        with perf_stage("draw"):
+            draw(fig, fig.subplots())
+        paths = []
+        for fmt in formats:
+            path = f"{output_base}.{fmt}"
+            with perf_stage("export", format=fmt, dpi=dpi):
+                fig.savefig(path, format=fmt, dpi=dpi, bbox_inches='tight')
+            paths.append(path)
+        return paths
+    finally:
+        fig.clear()
+
+
+def render_job(job):
+    """渲染单个任务 (在 worker 进程中执行)。返回 (输出名, 输出路径列表, 耗时, 错误信息)。"""
+    spec, spec_dir, output_base = job
+    start = time.perf_counter()
+    try:
+        draw = build_spec_draw(spec, spec_dir)
+        paths = save_figure(draw, output_base, formats=spec.get('formats', ['png']),
+                            dpi=spec.get('dpi', EXPORT_DPI), figsize=tuple(spec.get('figsize', RENDER_FIGSIZE)))
+        return output_base, paths, time.perf_counter() - start, None
+    except Exception as e:
+        return output_base, [], time.perf_counter() - start, f"{type(e).__name__}: {e}"
+
+
+def init_render_worker():
+    """worker 进程初始化：只执行一次，切换到 Agg 后端、关闭 Streamlit 裸运行日志并设置中文字体。"""
+    import matplotlib
+    matplotlib.use('Agg')
+    from streamlit import logger as st_logger
+    st_logger.set_log_level('error')
+    chinese_font()
+
+
+def batch_render_cli(argv=None):
+    """
+    命令行批量渲染：python paper_viz_app.py render SPECS [-o OUT] [-j N] [--formats png,svg]
+    SPECS 为规格文件或目录 (*.json / *.yaml)，任务在进程池中并行渲染。
+    """
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = argparse.ArgumentParser(prog="paper_viz_app.py render", description="按 JSON/YAML 规格批量渲染论文图表")
+    parser.add_argument("specs", help="规格文件或包含规格文件的目录")
+    parser.add_argument("-o", "--out", default="figures", help="输出目录 (默认 ./figures)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="并行进程数 (默认 CPU 核数)")
+    parser.add_argument("--formats", help="覆盖规格中的输出格式，如 png,svg")
+    args = parser.parse_args(argv)
+
+    formats = args.formats.split(',') if args.formats else None
+    jobs = collect_render_jobs(args.specs, args.out, formats)
+    if not jobs:
+        print(f"未找到规格文件: {args.specs}", file=sys.stderr)
+        return 1
+    os.makedirs(args.out, exist_ok=True)
+
+    start = time.perf_counter()
+    workers = max(1, min(args.jobs, len(jobs)))
+    if workers == 1:
+        init_render_worker()
+        results = map(render_job, jobs)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_render_worker)
+        results = pool.map(render_job, jobs)
+    failed = 0
+    for output_base, paths, seconds, error in results:
+        if error:
+            failed += 1
+            print(f"[失败] {output_base}: {error}", file=sys.stderr)
+        else:
+            print(f"[完成] {', '.join(paths)} ({seconds:.2f} s)")
+    if workers > 1:
+        pool.shutdown()
+    print(f"共 {len(jobs)} 个图表，失败 {failed} 个，{workers} 个进程，总耗时 {time.perf_counter() - start:.1f} s")
+    return 1 if failed else 0
+
+
+# --- 冷启动基准 ---
+STARTUP_PROBE_MODULES = ('numpy', 'pandas', 'matplotlib', 'matplotlib.pyplot', 'seaborn', 'requests')
+
+_IMPORT_PROBE = """
+import json, sys, time
+t = time.perf_counter()
+sys.path.insert(0, {app_dir!r})
+import paper_viz_app
+print(json.dumps({{"seconds": time.perf_counter() - t, "modules": [m for m in {modules!r} if m in sys.modules]}}))
+"""
+
+_FIRST_PAINT_PROBE = """
+import json, sys, time
+t = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file({app_path!r}, default_timeout=120).run()
+print(json.dumps({{"seconds": time.perf_counter() - t, "modules": [m for m in {modules!r} if m in sys.modules],
+                  "exceptions": [str(e.value) for e in at.exception]}}))
+"""
+
+
+def bench_startup(runs=5):
+    """
+    在全新的子进程中测量冷启动：模块导入耗时、首屏耗时 (含 Streamlit 导入与脚本首次运行)，
+    并记录首屏结束时已加载的重模块。返回可序列化为 JSON 的结果 (各项取中位数)。
+    """
+    import subprocess
+    app_path = os.path.abspath(__file__)
+    probes = {
+        "import": _IMPORT_PROBE.format(app_dir=os.path.dirname(app_path), modules=STARTUP_PROBE_MODULES),
+        "first_paint": _FIRST_PAINT_PROBE.format(app_path=app_path, modules=STARTUP_PROBE_MODULES),
+    }
+    result = {}
+    for name, code in probes.items():
+        samples = []
+        for _ in range(runs):
+            out = subprocess.run([sys.executable, "-W", "ignore", "-c", code], capture_output=True, text=True,
+                                 check=True)
+            samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        seconds = [sample["seconds"] for sample in samples]
+        result[name] = {"median_s": round(float(np.median(seconds)), 4), "samples_s": [round(x, 4) for x in seconds],
+                        "modules_loaded": samples[-1]["modules"]}
+        if samples[-1].get("exceptions"):
+            result[name]["exceptions"] = samples[-1]["exceptions"]
+    return result
+
+
+# --- 离线基准套件 (合成 GeoJSON / 点位 / 表格，输出 JSON 便于版本间对比) ---
+BENCH_SCALES = {
+    'small': {'features': 100, 'vertices': 200, 'points': 20_000, 'rows': 100_000},
+    'medium': {'features': 1_000, 'vertices': 500, 'points': 200_000, 'rows': 1_000_000},
+    'large': {'features': 3_000, 'vertices': 1_000, 'points': 2_000_000, 'rows': 5_000_000},
+}
+BENCH_SCHEMA = 1
+BENCH_TOLERANCE = 0.25  # 与基线相比中位耗时增加超过该比例视为退化
+BENCH_NOISE_FLOOR_S = 0.02  # 绝对差异小于此值时不判定退化
+# --keep-fixtures 时合成 CSV 夹具保留在此目录供下次复用，默认写入临时目录并在运行结束后删除
+BENCH_FIXTURE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "academicviz", "bench")
+
+
+def synthetic_geojson(n_features, vertices, seed=0):
+    """
+    合成行政区划：网格排列的星形多边形 (带随机起伏)。
+    每 5 个要素有 1 个为带小岛的 MultiPolygon，每 7 个要素有 1 个带孔洞，覆盖真实边界中的几种结构。
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_features)))
+    cell = 20.0 / side
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    features = []
+    for i in range(n_features):
+        cx, cy = 100 + (i % side + 0.5) * cell, 20 + (i // side + 0.5) * cell
+        radius = cell * 0.45 * (0.8 + 0.2 * np.sin(angles * rng.integers(3, 9)) * rng.random(vertices))
+        ring = np.column_stack([cx + radius * np.cos(angles), cy + radius * np.sin(angles)])
+        polygon = [np.vstack([ring, ring[:1]]).tolist()]
+        if i % 7 == 0:
+            hole = np.column_stack([cx + cell * 0.08 * np.cos(angles[::-8]), cy + cell * 0.08 * np.sin(angles[::-8])])
+            polygon.append(np.vstack([hole, hole[:1]]).tolist())
+        if i % 5 == 0:
+            island = [[cx + cell * 0.4, cy + cell * 0.4], [cx + cell * 0.45, cy + cell * 0.4],
+                      [cx + cell * 0.45, cy + cell * 0.45], [cx + cell * 0.4, cy + cell * 0.4]]
+            geometry = {'type': 'MultiPolygon', 'coordinates': [polygon, [island]]}
+        else:
+            geometry = {'type': 'Polygon', 'coordinates': polygon}
+        features.append({'type': 'Feature', 'geometry': geometry,
+                         'properties': {'name': f"区域{i}", 'adcode': 900000 + i, 'center': [cx, cy]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def synthetic_points(n_points, seed=0):
+    """覆盖合成区划范围的随机点位，带名称与数值列。"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'公司名称': _categorical(np.array([f"站点{i}" for i in range(1000)], dtype=object),
+                                                 rng.integers(0, 1000, n_points)),
+                         '经度': rng.uniform(100, 120, n_points), '纬度': rng.uniform(20, 40, n_points),
+                         '数值': rng.exponential(10, n_points)})
+
+
+def synthetic_table(rows, seed=0):
+    """实验 / 生存数据：分组、处理组、数值、随访时间与事件。"""
+    rng = np.random.default_rng(seed)
+    group = rng.integers(0, 6, rows)
+    return pd.DataFrame({'Group': pd.Categorical.from_codes(group, [f"G{i}" for i in range(6)]),
+                         'Arm': pd.Categorical.from_codes(rng.integers(0, 2, rows), ['Placebo', 'Drug']),
+                         'Value': rng.normal(10 + group, 2, rows),
+                         'Time': rng.exponential(30, rows).round(1),
+                         'Event': (rng.random(rows) < 0.7).astype(np.int8)})
+
+
+def bench_cases(scale, fixture_dir):
+    """生成某一规模的全部基准用例：{用例名: 无参函数}。夹具只生成一次，各用例共用；文件夹具写入 fixture_dir。"""
+    params = BENCH_SCALES[scale]
+    geojson = synthetic_geojson(params['features'], params['vertices'])
+    points = synthetic_points(params['points'])
+    table = synthetic_table(params['rows'])
+    feature_table = build_feature_table(geojson)
+    edges = feature_edges(geojson)
+    tolerance = simplify_tolerance(table_bounds(feature_table))
+    matrix = np.random.default_rng(0).normal(size=(params['rows'] // 100, 200))
+    csv_path = os.path.join(fixture_dir, f"bench_{params['rows']}.csv")
+    os.makedirs(fixture_dir, exist_ok=True)
+    if not os.path.exists(csv_path):
+        table.to_csv(csv_path, index=False)
+
+    def render_gis():
+        # 每次使用新的区域键，避免命中要素表 / 简化结果的进程内缓存
+        key = f"bench-{uuid.uuid4().hex}"
+        result = RenderResult(lambda fig, ax: render_gis_map(
+            fig, ax, geojson, key, {}, points, '经度', '纬度', '公司名称', title=scale))
+        result.export('png')
+        result.export('svg')
+
+    def render_bar():
+        result = RenderResult(lambda fig, ax: render_chart(fig, ax, table, 'bar', 'Group', 'Value', hue='Arm'))
+        result.export('svg')
+
+    return {
+        'ingest.csv': lambda: read_table(csv_path, csv_path),
+        'geometry.store': lambda: BoundaryGeometry.from_geojson(geojson),
+        'geometry.features': lambda: build_feature_table(geojson),
+        'geometry.join': lambda: spatial_join(points['经度'].to_numpy(), points['纬度'].to_numpy(), edges,
+                                              feature_table),
+        'geometry.simplify': lambda: simplify_geojson(geojson, tolerance),
+        'geometry.crawl': lambda: simulate_crawl(feature_table, rates=params['points'] / params['features'], seed=0),
+        'aggregate.groups': lambda: summarize_groups(table, 'Group', 'Value', 'Arm', error_bar='ci'),
+        'aggregate.survival': lambda: survival_analysis(table, 'Time', 'Event', 'Arm'),
+        'aggregate.heatmap': lambda: heatmap_grid(matrix, (2000, 2000), cluster_rows=True),
+        'render.gis': render_gis,
+        'render.bar': render_bar,
+    }
+
+
+def run_benchmarks(scales=('small',), repeat=3, cases=None, fixture_dir=None):
+    """
+    运行基准并返回可序列化为 JSON 的结果。每个用例先计时 repeat 次 (不统计内存，避免 tracemalloc 干扰耗时)，
+    再额外运行一次统计峰值内存；stages 为最后一次计时运行中各阶段的耗时 (毫秒，嵌套阶段会重复计入外层)。
+    峰值内存来自 tracemalloc，包含 Python 与 NumPy 的分配，不含 Matplotlib 渲染器的本地缓冲区。
+    fixture_dir 为 None 时文件夹具写入临时目录，结束后删除。
+    """
+    import platform
+    import tempfile
+    import matplotlib
+    if fixture_dir is None:
+        with tempfile.TemporaryDirectory(prefix="academicviz-bench-") as tmp_dir:
+            return run_benchmarks(scales, repeat, cases, tmp_dir)
+    with open(os.path.abspath(__file__), 'rb') as f:
+        source_hash = hashlib.sha1(f.read()).hexdigest()[:12]
+    meta = {'schema': BENCH_SCHEMA, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'source_sha1': source_hash,
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'matplotlib': matplotlib.__version__}
+    results = []
+    for scale in scales:
+        for name, func in bench_cases(scale, fixture_dir).items():
+            if cases and not any(name.startswith(c) for c in cases):
+                continue
+            samples = []
+            for _ in range(repeat):
+                with PerfRecorder() as perf:
+                    start = time.perf_counter()
+                    func()
+                    samples.append(time.perf_counter() - start)
+            # 整个用例作为一个外层阶段统计，内层阶段重置峰值时会把峰值传给外层
+            with PerfRecorder(trace_memory=True) as traced:
+                with perf_stage(f"bench.{name}"):
+                    func()
+            peak_mb = traced.records[-1].get('peak_mb', float('nan'))
+            stages = perf.summary()
+            results.append({'scale': scale, 'case': name, 'params': BENCH_SCALES[scale], 'repeat': repeat,
+                            'median_s': round(float(np.median(samples)), 4), 'min_s': round(min(samples), 4),
+                            'samples_s': [round(x, 4) for x in samples], 'peak_mb': round(peak_mb, 1),
+                            'stages_ms': dict(zip(stages['stage'], stages['total_ms'].round(2)))})
+            print(f"[{scale}] {name}: {results[-1]['median_s']:.3f} s, 峰值 {results[-1]['peak_mb']} MB",
+                  file=sys.stderr)
+    return {'meta': meta, 'results': results}
+
+
+def compare_benchmarks(current, baseline, tolerance=BENCH_TOLERANCE):
+    """与基线结果对比，返回退化列表 [(规模, 用例, 基线秒数, 当前秒数)]。"""
+    base = {(r['scale'], r['case']): r['median_s'] for r in baseline.get('results', [])}
+    regressions = []
+    for r in current['results']:
+        before = base.get((r['scale'], r['case']))
+        if before is not None and r['median_s'] > before * (1 + tolerance) \
+                and r['median_s'] - before > BENCH_NOISE_FLOOR_S:
+            regressions.append((r['scale'], r['case'], before, r['median_s']))
+    return regressions
+
+
+def bench_cli(argv):
+    """
+    命令行入口：python paper_viz_app.py bench [--scales small,medium] [--out 结果.json] [--baseline 基线.json]
+    [--keep-fixtures]
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="paper_viz_app.py bench", description="离线性能基准 (合成数据，输出 JSON)")
+    parser.add_argument("--scales", default="small", help=f"逗号分隔，可选 {', '.join(BENCH_SCALES)}")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cases", default=None, help="只运行名称以这些前缀开头的用例 (逗号分隔)")
+    parser.add_argument("--out", default=None, help="结果 JSON 路径 (默认输出到标准输出)")
+    parser.add_argument("--baseline", default=None, help="基线 JSON；出现退化时退出码为 1")
+    parser.add_argument("--tolerance", type=float, default=BENCH_TOLERANCE)
+    parser.add_argument("--keep-fixtures", action="store_true",
+                        help=f"合成 CSV 夹具保留在 {BENCH_FIXTURE_DIR} 供下次复用 (默认用临时目录，结束后删除)")
+    args = parser.parse_args(argv)
+
+    scales = [x for x in args.scales.split(',') if x]
+    unknown = [x for x in scales if x not in BENCH_SCALES]
+    if unknown:
+        parser.error(f"未知规模: {', '.join(unknown)}")
+    result = run_benchmarks(scales, args.repeat, args.cases.split(',') if args.cases else None,
+                            BENCH_FIXTURE_DIR if args.keep_fixtures else None)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare_benchmarks(result, json.load(f), args.tolerance)
+        for scale, case, before, after in regressions:
+            print(f"[退化] {scale} {case}: {before:.3f} s -> {after:.3f} s", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
 # --- 智能启动逻辑 ---
 if __name__ == "__main__":
+    # 命令行批量渲染：python paper_viz_app.py render <规格文件或目录>
+    if len(sys.argv) > 1 and sys.argv[1] == "render":
+        sys.exit(batch_render_cli(sys.argv[2:]))
+    # 离线基准套件：python paper_viz_app.py bench [--scales small,medium] [--baseline 基线.json]
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        sys.exit(bench_cli(sys.argv[2:]))
+    # 冷启动基准：python paper_viz_app.py bench-startup [运行次数]，输出 JSON
+    if len(sys.argv) > 1 and sys.argv[1] == "bench-startup":
+        print(json.dumps(bench_startup(int(sys.argv[2]) if len(sys.argv) > 2 else 5), ensure_ascii=False, indent=2))
+        sys.exit(0)
+
     try:
         from streamlit.web import cli as stcli
         from streamlit import runtime
@@ -474,7 +3640,7 @@ if __name__ == "__main__":
         if runtime.exists():
             main()
         else:
-            sys.argv = ["streamlit", "run", os.path.abspath(__file__)]
+            sys.argv = ["streamlit", "run", os.path.abspath(__file__), "--server.maxUploadSize", "1024"]
             sys.exit(stcli.main())
     except ImportError:
-        os.system(f'streamlit run "{os.path.abspath(__file__)}"')
\ No newline at end of file
+        os.system(f'streamlit run "{os.path.abspath(__file__)}" --server.maxUploadSize 1024')
\ No newline at end of file
@@ -0,0 +1,165 @@
+"""
+fetch_regions / BoundaryCache 的回归测试：用本地线程化 HTTP 服务代替 DataV 边界接口。
+运行：python -m pytest -q test_fetch_regions.py
+
+替身服务的行为：
+- 每个请求有固定延迟；
+- 450000 为省级，含 4 个地级市，每个市有 3 个区县；
+- 450200 第一次请求返回 503，重试后恢复；
+- 450300 始终返回 503；
+- 450400 返回 404；
+- 响应带 ETag，请求带匹配的 If-None-Match 时返回 304。
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import paper_viz_app as app
+
+LATENCY = 0.05
+PROVINCE = "450000"
+CITIES = ["450100", "450200", "450300", "450400"]
+DISTRICTS_PER_CITY = 3
+
+
+def square(x, y, size=1.0):
+    return [[[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]]
+
+
+def boundary_doc(adcode):
+    """替身服务返回的 GeoJSON；未知代码返回 None (404)。"""
+    if adcode == PROVINCE:
+        features = [{"type": "Feature", "properties": {"adcode": int(c), "name": f"市{c}", "childrenNum": 3},
+                     "geometry": {"type": "Polygon", "coordinates": square(i, 0)}} for i, c in enumerate(CITIES)]
+    elif adcode in CITIES[:3]:
+        i = CITIES.index(adcode)
+        features = [{"type": "Feature",
+                     "properties": {"adcode": int(adcode) + j + 1, "name": f"区{adcode}-{j}", "childrenNum": 0},
+                     "geometry": {"type": "Polygon", "coordinates": square(i + j / 3, 0, 1 / 3)}}
+                    for j in range(DISTRICTS_PER_CITY)]
+    else:
+        return None
+    return {"type": "FeatureCollection", "features": features}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    hits = {}
+    conditional = []
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        adcode = self.path.rsplit("/", 1)[-1][:6]
+        with self.lock:
+            self.hits[adcode] = self.hits.get(adcode, 0) + 1
+            hits = self.hits[adcode]
+        time.sleep(LATENCY)
+        if adcode == "450300" or (adcode == "450200" and hits == 1):
+            self.send_response(503)
+            self.end_headers()
+            return
+        doc = boundary_doc(adcode)
+        if doc is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = f'"{adcode}-v1"'
+        if self.headers.get("If-None-Match") == etag:
+            with self.lock:
+                self.conditional.append(adcode)
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        body = json.dumps(doc).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def datav(monkeypatch):
+    """启动替身服务并把边界接口地址指向它；缩短重试退避，避免测试等待过久。"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    StandInHandler.hits = {}
+    StandInHandler.conditional = []
+    monkeypatch.setattr(app, "DATAV_BOUND_URL", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(app, "GEOJSON_RETRY_BACKOFF", 0.01)
+    yield StandInHandler
+    server.shutdown()
+    server.server_close()
+
+
+def new_cache(tmp_path, **kwargs):
+    return app.BoundaryCache(cache_dir=str(tmp_path / "geojson"), seed_dir=None, **kwargs)
+
+
+def feature_codes(geojson):
+    return sorted(str(f["properties"]["adcode"]) for f in geojson["features"])
+
+
+def test_drill_down_merges_children_and_falls_back_to_parent(datav, tmp_path):
+    cache = new_cache(tmp_path)
+    targets = [(app.adcode_url(PROVINCE), "广西", True)]
+    geojson, report = app.fetch_regions(targets, cache, workers=4)
+
+    # 450100 / 450200 (503 后恢复) 各 3 个区县；450300 (持续 503) 与 450400 (404) 保留省级边界中的市要素
+    assert len(geojson["features"]) == 2 * DISTRICTS_PER_CITY + 2
+    assert "450300" in feature_codes(geojson) and "450400" in feature_codes(geojson)
+    assert "450200" not in feature_codes(geojson)
+    assert datav.hits["450200"] == 2
+
+    errors = {r["url"].rsplit("/", 1)[-1][:6]: r["error"] for r in report}
+    assert errors[PROVINCE] is None
+    assert errors["450100"] is None and errors["450200"] is None
+    assert errors["450300"] == f"重试 {app.GEOJSON_FETCH_RETRIES} 次后仍失败"
+    assert errors["450400"] == "HTTP 404"
+
+
+def test_multiple_regions_merge_and_report_per_region_errors(datav, tmp_path):
+    cache = new_cache(tmp_path)
+    targets = [(app.adcode_url("450100"), "市450100", False),
+               (app.adcode_url("450100"), "重复", False),
+               (app.adcode_url("450400"), "市450400", False)]
+    geojson, report = app.fetch_regions(targets, cache, workers=4)
+
+    # 同一要素只保留一份；单个地区失败不影响其它地区
+    assert len(geojson["features"]) == DISTRICTS_PER_CITY
+    assert [r["error"] for r in report] == [None, None, "HTTP 404"]
+
+
+def test_cache_key_uses_adcode_only_for_datav_urls(datav):
+    assert app.BoundaryCache.cache_key(app.adcode_url("450100")) == "450100_full"
+    assert app.BoundaryCache.cache_key(app.adcode_url("450102")) == "450102"
+    # 其他主机或接口版本的同名文件不能与 DataV 条目共用缓存
+    for url in ("https://example.com/areas_v2/bound/450100_full.json",
+                app.DATAV_BOUND_URL + "/v2/450100_full.json",
+                app.DATAV_BOUND_URL + "/450100_full.json?v=2"):
+        assert app.BoundaryCache.cache_key(url) not in ("450100", "450100_full")
+
+
+def test_revalidation_uses_etag_and_304(datav, tmp_path):
+    cache = new_cache(tmp_path, revalidate_after=0)
+    url = app.adcode_url("450100")
+    first, source = cache.get(url)
+    assert source == "network"
+
+    second, source = cache.get(url)
+    assert source == "revalidated"
+    assert second == first
+    assert datav.conditional == ["450100"]
+    assert cache.stats["revalidated"] == 1 and cache.stats["misses"] == 1
+
+    # 新实例从磁盘读取后同样走条件请求
+    _, source = new_cache(tmp_path, revalidate_after=0).get(url)
+    assert source == "revalidated"